@@ -0,0 +1,97 @@
+import argparse
+import json
+import random
+import sys
+from array import array
+
+import main
+
+NOTE_COUNTS = [1000, 10000, 30000, 100000]
+
+def make_synthetic_chart(note_count, duration_ms, keys=main.DEFAULT_KEYS, holds=0.0, seed=0):
+    # Evenly spaced rows with random chords until note_count notes are placed.
+    # A share of holds of the notes are turned into holds lasting until the
+    # row before the next note of their lane.
+    rng = random.Random(seed)
+    masks = array('I')
+    placed = 0
+    while placed < note_count:
+        mask = rng.randrange(1, 1 << keys)
+        # Drop lanes from the last row so the total is exact
+        while placed + bin(mask).count('1') > note_count:
+            mask &= mask - 1
+        masks.append(mask)
+        placed += bin(mask).count('1')
+    if holds:
+        for lane in range(keys):
+            rows = [i for i, mask in enumerate(masks) if mask >> lane & 1]
+            for row, next_row in zip(rows, rows[1:]):
+                if next_row > row + 1 and rng.random() < holds:
+                    masks[row] ^= 1 << lane | 1 << (main.HOLD_HEAD_SHIFT + lane)
+                    masks[next_row - 1] |= 1 << (main.HOLD_TAIL_SHIFT + lane)
+    step = duration_ms / len(masks)
+    times = array('i', (int(i * step) for i in range(len(masks))))
+    return {'noteSpeed': 15, 'keys': keys}, times, masks
+
+def summarize(name, notes, stats):
+    frame_ms = [u + r for u, r in zip(stats['update_ms'], stats['render_ms'])]
+    return {
+        'chart': name,
+        'notes': notes,
+        'frames': stats['frames'],
+        'update_p50': main.percentile(stats['update_ms'], 50),
+        'update_p99': main.percentile(stats['update_ms'], 99),
+        'render_p50': main.percentile(stats['render_ms'], 50),
+        'render_p99': main.percentile(stats['render_ms'], 99),
+        'frame_p50': main.percentile(frame_ms, 50),
+        'frame_p99': main.percentile(frame_ms, 99),
+        'spawned': stats['spawned'],
+        'judged': stats['judged'],
+        'despawned': stats['despawned'],
+    }
+
+def print_header():
+    print(f"{'chart':<20}{'notes':>8}{'frames':>8}{'upd p50':>9}{'upd p99':>9}"
+          f"{'rnd p50':>9}{'rnd p99':>9}{'frm p50':>9}{'frm p99':>9}")
+
+def print_row(r):
+    print(f"{r['chart']:<20}{r['notes']:>8}{r['frames']:>8}{r['update_p50']:>9.3f}{r['update_p99']:>9.3f}"
+          f"{r['render_p50']:>9.3f}{r['render_p99']:>9.3f}{r['frame_p50']:>9.3f}{r['frame_p99']:>9.3f}")
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Headless frame time benchmark for Pysu!Mania")
+    parser.add_argument('charts', nargs='*', help="chart JSON files to replay instead of the synthetic suite")
+    parser.add_argument('--notes', type=int, nargs='+', default=NOTE_COUNTS, help="synthetic chart note counts")
+    parser.add_argument('--keys', type=int, default=main.DEFAULT_KEYS, choices=sorted(main.LANE_SPRITES),
+                        help="synthetic chart lane count")
+    parser.add_argument('--holds', type=float, default=0.0, help="share of synthetic chart notes that are holds")
+    parser.add_argument('--duration', type=float, default=60, help="synthetic chart length in seconds")
+    parser.add_argument('--fps', type=int, default=main.FPS)
+    parser.add_argument('--size', type=int, nargs=2, default=(1280, 720), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--no-render', action='store_true', help="only time the game logic")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    runs = []
+    if args.charts:
+        for path in args.charts:
+            runs.append((path, main.load_chart(path)))
+    else:
+        for count in args.notes:
+            runs.append((f"synthetic-{count}", make_synthetic_chart(count, args.duration * 1000, args.keys, args.holds)))
+
+    results = []
+    print_header()
+    for name, chart in runs:
+        stats = main.run_headless(chart, size=tuple(args.size), fps=args.fps, render=not args.no_render)
+        notes = sum(bin(mask & ((1 << main.HOLD_TAIL_SHIFT) - 1)).count('1') for mask in chart[2])
+        results.append(summarize(name, notes, stats))
+        print_row(results[-1])
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
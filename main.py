@@ -2,26 +2,109 @@ import pygame
 import sys
 import os
 import json
+import math
+import hashlib
+import mmap
+import struct
+import time
+import atexit
+import queue
+import sqlite3
+import threading
+import io
+import csv
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from itertools import chain
+from collections import deque, OrderedDict
 
 # Settings
 FPS = 60
-DIRECTIONS = ['left', 'down', 'up', 'right']
-
-KEY_MAPPING = {
-    pygame.K_a: 'left',
-    pygame.K_s: 'down',
-    pygame.K_k: 'up',
-    pygame.K_l: 'right'
+IDLE_FPS = 30  # menu, results and pause screens only redraw on input
+INPUT_HZ = 1000  # input polling and judgment rate while playing, independent of FPS
+# Receptor sprite of each lane, by the key count a chart declares in "keys"
+LANE_SPRITES = {
+    4: ['left', 'down', 'up', 'right'],
+    5: ['left', 'down', 'center', 'up', 'right'],
+    6: ['left', 'bent', 'down', 'up', 'bentright', 'right'],
+    7: ['left', 'bent', 'down', 'center', 'up', 'bentright', 'right'],
+}
+DEFAULT_KEYS = 4
+# Key names of each lane (see pygame.key.name), overridden per key count by
+# KEYMAP_FILE, e.g. {"7": ["a", "s", "d", "space", "j", "k", "l"]}
+KEYMAP_FILE = 'keymaps.json'
+DEFAULT_KEYMAPS = {
+    4: ['a', 's', 'k', 'l'],
+    5: ['a', 's', 'space', 'k', 'l'],
+    6: ['s', 'd', 'f', 'j', 'k', 'l'],
+    7: ['s', 'd', 'f', 'space', 'j', 'k', 'l'],
 }
 
 HEALTH_MAX = 100
 RECEPTOR_Y = 700  # y position of receptors (adjust to your screen height)
+# Gameplay positions are in pixels of this screen height, graphics are scaled to the real one
+REFERENCE_HEIGHT = 1080
+# Receptor graphics, each also has a pressed/note variant with a D suffix
+ATLAS_SPRITES = ['left', 'down', 'up', 'right', 'center', 'bent', 'bentright']
+# Max distance in ms between a key press and the note's hit time
 HIT_WINDOWS = {
     'sick': 30,
     'good': 60,
     'bad': 100,
     'trash': 130
 }
+# Notes are scrolled at noteSpeed pixels per frame of this reference rate,
+# independent of the actual frame rate
+NOTE_SPEED_FPS = 60
+NOTE_SPAWN_Y = -100
+# Chart rows are lane bitmasks with one byte each for taps ('o' in a musicSheet
+# line), hold heads ('h') and hold tails ('t')
+HOLD_HEAD_SHIFT = 8
+HOLD_TAIL_SHIFT = 16
+NOTE_CHARS = {'o': 0, 'h': HOLD_HEAD_SHIFT, 't': HOLD_TAIL_SHIFT}
+HOLD_BODY_WIDTH = 40  # at REFERENCE_HEIGHT
+HOLD_BODY_COLOR = (170, 170, 170, 160)
+NOTE_POOL_SIZE = 64
+SYNC_CORRECTION = 0.1  # share of the mixer drift corrected per mixer update
+SYNC_SNAP_MS = 100  # drift beyond this is corrected at once
+REPLAY_DIR = 'replays'
+# magic, version, little endian flag, event count, metadata length
+REPLAY_HEADER = struct.Struct('<4sHHII')
+REPLAY_MAGIC = b'PYSR'
+REPLAY_VERSION = 1
+REPLAY_KEY_DOWN = 0x80  # event code is the lane number, with this bit set for presses
+SCORE_DB = '.scores.db'
+SCORE_BATCH_SIZE = 32
+SCORE_BATCH_WAIT = 0.5  # seconds the writer waits to fill a batch
+TIMING_BIN_MS = 10  # width of the per-lane timing error histogram bins
+LEADERBOARD_SIZE = 5
+CALIBRATION_FILE = '.calibration.json'
+CALIBRATION_INTERVAL_MS = 500
+CALIBRATION_TAPS = 16
+CHART_CACHE_DIR = '.chart_cache'
+# magic, version, little endian flag, row count, source mtime, source size, metadata length
+CHART_HEADER = struct.Struct('<4sHHIqqI')
+CHART_MAGIC = b'PYSC'
+CHART_VERSION = 4
+# Charts with this extension have their metadata on the first line, marked with
+# "format": LINE_CHART_FORMAT, and then one musicSheet row per line in time
+# order, so long ones can be played while read
+LINE_CHART_EXT = '.jsonl'
+LINE_CHART_FORMAT = 'pysu-chart'
+CHART_STREAM_LEAD_MS = 10000  # song time compiled before a streamed chart starts
+CHART_STREAM_BATCH = 256  # rows compiled between wake-ups of a waiting reader
+HOLD_MAX_MS = CHART_STREAM_LEAD_MS  # longest hold, a head with no tail by then is a tap
+# Directories scanned for song charts, extra ones can be given in PYSU_SONG_DIRS
+SONG_DIRS = ['.', 'songs'] + [d for d in os.environ.get('PYSU_SONG_DIRS', '').split(os.pathsep) if d]
+SONG_INDEX_FILE = '.song_index.json'
+SONG_INDEX_VERSION = 5
+TEXT_CACHE_SIZE = 256
+TEXTURE_CACHE_SIZE = 64
+AUDIO_CACHE_SIZE = 4  # songs kept in memory, the highlighted one is preloaded
+SONG_LIST_Y = 150
+SONG_ROW_HEIGHT = 40
+SEARCH_TIMEOUT_MS = 1000  # type-ahead search restarts after this much idle time
 FIRE_COMBO_THRESHOLD = 15
 fire_colors = [
     (255, 50, 0),
@@ -29,86 +112,870 @@ fire_colors = [
     (255, 150, 0),
     (255, 200, 0),
 ]
+GLOW_CACHE_SIZE = 64
+# Performance HUD (toggled with PERF_HUD_KEY) and profiling of played frames.
+# PYSU_PERF_HUD=1 shows the HUD from the start, PYSU_PERF_LOG=file.csv or
+# file.json logs every frame's timings, PYSU_PROFILE=N captures the first N
+# played frames with cProfile, PROFILE_KEY captures the next PROFILE_FRAMES.
+PERF_HUD = os.environ.get('PYSU_PERF_HUD', '') not in ('', '0')
+PERF_LOG = os.environ.get('PYSU_PERF_LOG')
+try:
+    PROFILE_ON_START = int(os.environ.get('PYSU_PROFILE') or 0)
+except ValueError:
+    print(f"Ignoring PYSU_PROFILE={os.environ['PYSU_PROFILE']!r}, expected a number of frames")
+    PROFILE_ON_START = 0
+PERF_HUD_KEY = pygame.K_F3
+PROFILE_KEY = pygame.K_F4
+PERF_PHASES = ['events', 'spawn', 'update', 'draw']
+PERF_WINDOW = 240  # frames in the HUD's rolling stats
+PERF_HUD_REFRESH_MS = 250
+PROFILE_FRAMES = 600
+PROFILE_DIR = 'profiles'
 
 class Note:
-    def __init__(self, direction, image, x):
-        self.direction = direction
-        self.image = image
-        self.x = x
-        self.y = -100 
-
-    def update(self, speed):
-        self.y += speed
-
-    def draw(self, surface):
-        rect = self.image.get_rect(center=(self.x, int(self.y)))
-        surface.blit(self.image, rect)
+    # A tap, or the head of a hold whose end_time is set once its tail spawns
+    __slots__ = ('lane', 'y', 'hit_time', 'hold', 'end_time')
+
+    def __init__(self, lane=0, hit_time=0, hold=False):
+        self.reset(lane, hit_time, hold)
+
+    def reset(self, lane, hit_time, hold=False):
+        self.lane = lane
+        self.hit_time = hit_time
+        self.hold = hold
+        self.end_time = None
+        self.y = NOTE_SPAWN_Y
+
+    def update(self, now, px_per_ms):
+        self.y = RECEPTOR_Y - (self.hit_time - now) * px_per_ms
+
+class NotePool:
+    # Recycles Note objects so spawning and despawning during play never allocates
+    def __init__(self, size=NOTE_POOL_SIZE):
+        self.free = [Note() for _ in range(size)]
+
+    def acquire(self, lane, hit_time, hold=False):
+        if not self.free:
+            return Note(lane, hit_time, hold)
+        note = self.free.pop()
+        note.reset(lane, hit_time, hold)
+        return note
+
+    def release(self, note):
+        self.free.append(note)
+
+def get_time_ms():
+    return time.perf_counter() * 1000
+
+class SongClock:
+    # Song position in ms, negative during the lead-in before the music starts.
+    # Runs on the smooth wall clock, which is nudged towards the mixer position
+    # while music plays so drift is corrected without visible jumps.
+    def __init__(self, lead_in_ms=0, audio_offset=0, visual_offset=0):
+        self.start = get_time_ms() + lead_in_ms
+        self.pause_start = None
+        self.music_started = False
+        self.audio_offset = audio_offset
+        self.visual_offset = visual_offset
+        self.last_mixer_pos = None
+        self.drift = 0
+        self.last_time = -lead_in_ms
+
+    def start_music(self):
+        self.music_started = True
+
+    def pause(self):
+        if self.pause_start is None:
+            self.pause_start = get_time_ms()
+
+    def resume(self):
+        if self.pause_start is not None:
+            self.start += get_time_ms() - self.pause_start
+            self.pause_start = None
+
+    def wall_time(self):
+        return (self.pause_start if self.pause_start is not None else get_time_ms()) - self.start
+
+    def sync(self):
+        # get_pos only advances once per audio buffer, so each new reading moves
+        # the clock part of the way there; large jumps (stalls) are taken at once
+        if not (self.music_started and pygame.mixer.music.get_busy()):
+            return
+        pos = pygame.mixer.music.get_pos()
+        if pos == self.last_mixer_pos:
+            return
+        self.last_mixer_pos = pos
+        self.drift = pos - self.wall_time()
+        if abs(self.drift) > SYNC_SNAP_MS:
+            self.start -= self.drift
+        else:
+            self.start -= self.drift * SYNC_CORRECTION
+
+    def raw_time(self):
+        # Position in the mixer's terms, without the calibrated offsets
+        self.sync()
+        # Never let notes move backwards after a correction
+        self.last_time = max(self.last_time, self.wall_time())
+        return self.last_time
+
+    def time(self):
+        # When the audio at this position is heard, used for judgment
+        return self.raw_time() - self.audio_offset
+
+    def visual_time(self):
+        # Position to draw so notes line up with the audio once displayed
+        return self.time() + self.visual_offset
+
+def get_scroll_speed(note_speed):
+    # noteSpeed is in pixels per reference frame, convert to pixels per ms
+    return note_speed * NOTE_SPEED_FPS / 1000
+
+def get_lead_time(px_per_ms):
+    # Time a note needs to travel from its spawn point to the receptors
+    return int((RECEPTOR_Y - NOTE_SPAWN_Y) / px_per_ms)
+
+class TextCache:
+    # LRU cache of rendered text surfaces keyed by (text, font, color, scale).
+    # Callers may set_alpha on a returned surface but must set it before every blit.
+    def __init__(self, size=TEXT_CACHE_SIZE):
+        self.size = size
+        self.surfaces = OrderedDict()
+
+    def render(self, font, text, color, scale=1.0):
+        key = (text, font, color, scale)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = font.render(text, True, color)
+            if scale != 1.0:
+                size = (int(surface.get_width() * scale), int(surface.get_height() * scale))
+                surface = pygame.transform.smoothscale(surface, size)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+class DirtyRenderer:
+    # Draws onto the screen while tracking the touched rects, so only the areas
+    # that changed since the last frame are pushed to the display
+    def __init__(self, screen, background=(0, 0, 0)):
+        self.screen = screen
+        self.background = background
+        self.rects = []
+        self.prev_rects = []
+        self.full = True
+        self.invalidated = True
+
+    def invalidate(self):
+        # Redraw and present the whole screen on the next frame
+        self.invalidated = True
+
+    def begin(self, full=False, background=None):
+        # A full frame is always followed by one more, to clear what it left behind
+        self.full = full or self.invalidated
+        self.invalidated = full
+        if self.full:
+            self.screen.fill(background or self.background)
+        else:
+            for rect in self.prev_rects:
+                self.screen.fill(self.background, rect)
+        self.rects = []
+
+    def blit(self, source, dest, area=None):
+        rect = self.screen.blit(source, dest, area)
+        self.rects.append(rect)
+        return rect
+
+    def blits(self, blit_sequence):
+        self.rects.extend(self.screen.blits(blit_sequence))
+
+    def draw_rect(self, color, rect):
+        rect = pygame.draw.rect(self.screen, color, rect)
+        self.rects.append(rect)
+        return rect
+
+    def end(self):
+        if self.full:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.prev_rects + self.rects)
+        self.prev_rects = self.rects
+
+class EffectCache:
+    # Fire effect colours and combo glow surfaces, built once and reused
+    def __init__(self, background=(0, 0, 0)):
+        # The fire overlay is drawn over a plain background, so blending it once
+        # gives a solid colour to fill with instead of a per-pixel alpha blit
+        self.fire_backgrounds = []
+        for frame, color in enumerate(fire_colors):
+            alpha = (60 + frame * 20) / 255
+            self.fire_backgrounds.append(tuple(int(c * alpha + b * (1 - alpha)) for c, b in zip(color, background)))
+        self.glows = OrderedDict()
+
+    def fire_background(self, frame):
+        return self.fire_backgrounds[frame]
+
+    def glow(self, size, color, alpha):
+        key = (size, color, alpha)
+        surface = self.glows.get(key)
+        if surface is None:
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            pygame.draw.ellipse(surface, (*color, alpha), surface.get_rect())
+            self.glows[key] = surface
+            if len(self.glows) > GLOW_CACHE_SIZE:
+                self.glows.popitem(last=False)
+        else:
+            self.glows.move_to_end(key)
+        return surface
 
 def list_json_files():
-    return [f for f in os.listdir('.') if f.endswith('.json')]
-
-def get_song_title(json_file):
-    try:
+    # (path, stat) for every JSON or line-delimited chart in the song directories
+    files = []
+    for song_dir in SONG_DIRS:
+        try:
+            entries = list(os.scandir(song_dir))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(('.json', LINE_CHART_EXT)) and not entry.name.startswith('.') and entry.is_file():
+                files.append((os.path.normpath(entry.path), entry.stat()))
+    return files
+
+def get_song_title(json_file, song_data):
+    if 'song' in song_data and song_data['song']:
+        return os.path.splitext(os.path.basename(song_data['song']))[0]
+    return os.path.splitext(os.path.basename(json_file))[0]
+
+def resolve_song_path(json_file, song):
+    # Audio is looked up next to the chart first, then from the working directory
+    if not song:
+        return None
+    beside_chart = os.path.join(os.path.dirname(json_file), song)
+    return beside_chart if os.path.isfile(beside_chart) else song
+
+def index_song(json_file):
+    if json_file.endswith(LINE_CHART_EXT):
+        # Only the metadata line, the rows are read while the chart is played
         with open(json_file, 'r') as f:
-            data = json.load(f)
-            if 'song' in data and data['song']:
-                return os.path.splitext(os.path.basename(data['song']))[0]
+            meta = read_chart_header(f)
+        note_count = duration = difficulty = None
+    else:
+        meta, times, masks = load_chart(json_file)
+        # Taps and hold heads, tails are part of their hold
+        note_count = sum(bin(mask & ((1 << HOLD_TAIL_SHIFT) - 1)).count('1') for mask in masks)
+        duration = times[-1] if len(times) else 0
+        # Notes per second over the whole chart
+        difficulty = round(note_count * 1000 / duration, 2) if duration else 0
+    return {
+        'title': get_song_title(json_file, meta),
+        'song': resolve_song_path(json_file, meta.get('song')),
+        'bpm': meta.get('bpm', 120),
+        'keys': meta['keys'],
+        'notes': note_count,
+        'duration': duration,
+        'difficulty': difficulty,
+    }
+
+def get_song_label(song):
+    if song['keys'] == DEFAULT_KEYS:
+        return song['title']
+    return f"{song['title']} [{song['keys']}K]"
+
+def load_song_library():
+    # Song metadata from the index file, only charts whose mtime or size
+    # changed since the last run are parsed again
+    try:
+        with open(SONG_INDEX_FILE, 'r') as f:
+            index = json.load(f)
+        if index.get('version') != SONG_INDEX_VERSION:
+            index = {}
+    except (OSError, ValueError):
+        index = {}
+    cached = index.get('songs', {})
+
+    songs = {}
+    changed = False
+    for path, stat in list_json_files():
+        entry = cached.get(path)
+        if not entry or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            try:
+                info = index_song(path)
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                # Not a chart, remember it so it isn't parsed again
+                info = None
+            entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'info': info}
+            changed = True
+        songs[path] = entry
+    if changed or len(songs) != len(cached):
+        try:
+            tmp_path = SONG_INDEX_FILE + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': SONG_INDEX_VERSION, 'songs': songs}, f)
+            os.replace(tmp_path, SONG_INDEX_FILE)
+        except OSError as e:
+            print(f"Error writing song index: {e}")
+
+    library = [dict(entry['info'], path=path) for path, entry in songs.items() if entry['info']]
+    library.sort(key=lambda song: song['title'].lower())
+    return library
+
+def get_chart_keys(meta):
+    keys = meta.get('keys', DEFAULT_KEYS)
+    if keys not in LANE_SPRITES:
+        raise ValueError(f"unsupported key count {keys}")
+    return keys
+
+def compile_rows(rows, keys):
+    # (time, lane bitmask) for each (time, musicSheet line) row given in time
+    # order. A hold needs its tail before the next note of its lane, otherwise
+    # it is played as a tap, so rows are held back while a hold is open until
+    # that is decided, at most HOLD_MAX_MS. Tails without a hold are dropped.
+    pending = deque()
+    open_heads = [None] * keys
+    open_count = 0
+    for hit_time, line in rows:
+        mask = 0
+        for i, char in enumerate(line.split()[:keys]):
+            if char in NOTE_CHARS:
+                mask |= 1 << (NOTE_CHARS[char] + i)
+        if not mask:
+            continue
+        if open_count:
+            for lane, head in enumerate(open_heads):
+                if head is not None and hit_time - head[0] > HOLD_MAX_MS:
+                    head[1] ^= 1 << lane | 1 << (HOLD_HEAD_SHIFT + lane)
+                    open_heads[lane] = None
+                    open_count -= 1
+        row = [hit_time, mask]
+        lanes = (mask | mask >> HOLD_HEAD_SHIFT | mask >> HOLD_TAIL_SHIFT) & ((1 << HOLD_HEAD_SHIFT) - 1)
+        while lanes:
+            lane = (lanes & -lanes).bit_length() - 1
+            lanes &= lanes - 1
+            if row[1] >> (HOLD_TAIL_SHIFT + lane) & 1:
+                if open_heads[lane] is None:
+                    row[1] &= ~(1 << (HOLD_TAIL_SHIFT + lane))
+                else:
+                    open_heads[lane] = None
+                    open_count -= 1
+            if row[1] & (1 << lane | 1 << (HOLD_HEAD_SHIFT + lane)) and open_heads[lane] is not None:
+                open_heads[lane][1] ^= 1 << lane | 1 << (HOLD_HEAD_SHIFT + lane)
+                open_heads[lane] = None
+                open_count -= 1
+            if row[1] >> (HOLD_HEAD_SHIFT + lane) & 1:
+                open_heads[lane] = row
+                open_count += 1
+        pending.append(row)
+        if not open_count:
+            while pending:
+                hit_time, mask = pending.popleft()
+                if mask:
+                    yield hit_time, mask
+    for lane, row in enumerate(open_heads):
+        if row is not None:
+            row[1] ^= 1 << lane | 1 << (HOLD_HEAD_SHIFT + lane)
+    for hit_time, mask in pending:
+        if mask:
+            yield hit_time, mask
+
+def compile_chart(song_data):
+    # Turn the musicSheet rows into parallel arrays of hit times and lane bitmasks
+    keys = get_chart_keys(song_data)
+    rows = sorted(((int(row['time']), row['line']) for row in song_data['musicSheet']), key=lambda row: row[0])
+    times = array('i')
+    masks = array('I')
+    for hit_time, mask in compile_rows(rows, keys):
+        times.append(hit_time)
+        masks.append(mask)
+    meta = {k: v for k, v in song_data.items() if k != 'musicSheet'}
+    meta['keys'] = keys
+    return meta, times, masks
+
+def read_chart_header(f):
+    # Metadata of a line-delimited chart, the JSON object on its first line
+    meta = json.loads(f.readline())
+    if not isinstance(meta, dict) or meta.get('format') != LINE_CHART_FORMAT:
+        raise ValueError("not a line-delimited chart")
+    meta['keys'] = get_chart_keys(meta)
+    return meta
+
+def read_chart_rows(f):
+    # (time, line) rows of a line-delimited chart, one JSON object per line
+    # after the metadata, which have to be in time order to be streamed
+    last_time = None
+    for text in f:
+        if not text.strip():
+            continue
+        row = json.loads(text)
+        hit_time = int(row['time'])
+        if last_time is not None and hit_time < last_time:
+            raise ValueError(f"row at {hit_time} ms is out of time order")
+        last_time = hit_time
+        yield hit_time, row['line']
+
+def get_chart_cache_path(json_file):
+    key = hashlib.sha1(os.path.abspath(json_file).encode('utf-8')).hexdigest()
+    return os.path.join(CHART_CACHE_DIR, f"{key}.chart")
+
+def write_chart_cache(cache_path, stat, meta, times, masks):
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    # Pad so the arrays start 4-byte aligned and can be cast from a memory map
+    meta_bytes += b' ' * (-(CHART_HEADER.size + len(meta_bytes)) % 4)
+    header = CHART_HEADER.pack(CHART_MAGIC, CHART_VERSION, sys.byteorder == 'little',
+                               len(times), stat.st_mtime_ns, stat.st_size, len(meta_bytes))
+    os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(meta_bytes)
+        times.tofile(f)
+        masks.tofile(f)
+    os.replace(tmp_path, cache_path)
+
+def read_chart_cache(cache_path, stat):
+    with open(cache_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, little, count, mtime_ns, size, meta_len = CHART_HEADER.unpack_from(mm)
+    if (magic != CHART_MAGIC or version != CHART_VERSION or little != (sys.byteorder == 'little')
+            or mtime_ns != stat.st_mtime_ns or size != stat.st_size):
+        mm.close()
+        return None
+    meta = json.loads(mm[CHART_HEADER.size:CHART_HEADER.size + meta_len])
+    offset = CHART_HEADER.size + meta_len
+    view = memoryview(mm)
+    times = view[offset:offset + count * 4].cast('i')
+    masks = view[offset + count * 4:offset + count * 8].cast('I')
+    return meta, times, masks
+
+def get_cached_chart(json_file, stat):
+    try:
+        return read_chart_cache(get_chart_cache_path(json_file), stat)
+    except (OSError, ValueError, struct.error):
+        return None
+
+class ChartStream:
+    # Compiles a line-delimited chart on a background thread. times and masks
+    # grow as rows are compiled, so play can start with the first seconds of
+    # a marathon chart while the rest is read, and the compiled cache is
+    # written once the whole chart is in.
+    def __init__(self, json_file, stat):
+        self.path = json_file
+        self.stat = stat
+        self.file = open(json_file, 'r')
+        try:
+            self.meta = read_chart_header(self.file)
+        except (ValueError, AttributeError):
+            self.file.close()
+            raise
+        self.times = array('i')
+        self.masks = array('I')
+        self.done = False
+        self.error = None
+        self.progress = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='chart-stream', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            with self.file:
+                for hit_time, mask in compile_rows(read_chart_rows(self.file), self.meta['keys']):
+                    # Game.spawn goes by len(times), so the mask has to be there first
+                    self.masks.append(mask)
+                    self.times.append(hit_time)
+                    if len(self.times) % CHART_STREAM_BATCH == 0:
+                        with self.progress:
+                            self.progress.notify_all()
+                        # Let the game loop have the GIL between batches
+                        time.sleep(0)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Error reading chart {self.path}: {e}")
+            self.error = e
+        if self.error is None:
+            try:
+                write_chart_cache(get_chart_cache_path(self.path), self.stat, self.meta, self.times, self.masks)
+            except OSError as e:
+                print(f"Error writing chart cache: {e}")
+        with self.progress:
+            self.done = True
+            self.progress.notify_all()
+
+    def wait(self, until_time=None):
+        # Blocks until the rows up to until_time ms are compiled, or all of them.
+        # The arrays mustn't be hashed or exported before the stream is done.
+        with self.progress:
+            self.progress.wait_for(lambda: self.done or (until_time is not None and len(self.times)
+                                                         and self.times[-1] >= until_time))
+
+def open_chart(json_file):
+    # Returns (metadata, hit times, lane bitmasks, stream), served from the
+    # compiled cache while the source file is unchanged. Line-delimited charts
+    # that aren't cached are streamed: this returns once their first
+    # CHART_STREAM_LEAD_MS are compiled, with the ChartStream still filling the
+    # arrays. stream is None when they are complete.
+    stat = os.stat(json_file)
+    cached = get_cached_chart(json_file, stat)
+    if cached:
+        return (*cached, None)
+
+    if json_file.endswith(LINE_CHART_EXT):
+        stream = ChartStream(json_file, stat)
+        stream.wait(CHART_STREAM_LEAD_MS)
+        return stream.meta, stream.times, stream.masks, stream
+
+    with open(json_file, 'r') as f:
+        meta, times, masks = compile_chart(json.load(f))
+    try:
+        write_chart_cache(get_chart_cache_path(json_file), stat, meta, times, masks)
+    except OSError as e:
+        print(f"Error writing chart cache: {e}")
+    return meta, times, masks, None
+
+def load_chart(json_file):
+    # Returns (metadata, hit times, lane bitmasks) of the whole chart
+    meta, times, masks, stream = open_chart(json_file)
+    if stream:
+        stream.wait()
+        if stream.error:
+            raise stream.error
+    return meta, times, masks
+
+class AssetManager:
+    # Textures loaded once and kept by (name, size), and song audio read into
+    # memory on a worker thread ahead of time, both evicted least recently used
+    def __init__(self):
+        self.textures = OrderedDict()
+        self.audio = OrderedDict()
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='asset-loader')
+
+    def get_texture(self, name, size=None):
+        key = (name, size)
+        texture = self.textures.get(key)
+        if texture is None:
+            if size is None:
+                texture = pygame.image.load(f"graphics/{name}.png").convert_alpha()
             else:
-                return os.path.splitext(os.path.basename(json_file))[0]
-    except Exception:
-        return os.path.splitext(os.path.basename(json_file))[0]
-
-def load_images():
-    receptors = {}
-    notes = {}
-    for direction in DIRECTIONS:
-        receptors[direction] = pygame.image.load(f"graphics/{direction}Receptor.png").convert_alpha()
-        notes[direction] = pygame.image.load(f"graphics/{direction}ReceptorD.png").convert_alpha()
-    return receptors, notes
+                texture = pygame.transform.smoothscale(self.get_texture(name), size)
+            self.textures[key] = texture
+            if len(self.textures) > TEXTURE_CACHE_SIZE:
+                self.textures.popitem(last=False)
+        else:
+            self.textures.move_to_end(key)
+        return texture
+
+    def preload_audio(self, path):
+        if not path or not os.path.isfile(path):
+            return
+        if path in self.audio:
+            self.audio.move_to_end(path)
+            return
+        # Scrolling past songs should not leave their reads queued ahead of this one
+        for queued, future in list(self.audio.items()):
+            if future.cancel():
+                del self.audio[queued]
+        self.audio[path] = self.loader.submit(read_file, path)
+        if len(self.audio) > AUDIO_CACHE_SIZE:
+            self.audio.popitem(last=False)[1].cancel()
+
+    def get_audio(self, path):
+        # File-like object for pygame.mixer.music.load, waits if still loading
+        self.preload_audio(path)
+        return io.BytesIO(self.audio[path].result())
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+class SpriteAtlas:
+    # Every receptor and note graphic scaled once for the screen height and
+    # packed side by side into one surface, drawn through source rects
+    def __init__(self, assets, screen_height):
+        self.scale = screen_height / REFERENCE_HEIGHT
+        images = {}
+        for sprite in ATLAS_SPRITES:
+            for name in (f"{sprite}Receptor", f"{sprite}ReceptorD"):
+                image = assets.get_texture(name)
+                size = (max(1, round(image.get_width() * self.scale)), max(1, round(image.get_height() * self.scale)))
+                images[name] = assets.get_texture(name, size)
+
+        self.surface = pygame.Surface((sum(image.get_width() for image in images.values()),
+                                       max(image.get_height() for image in images.values())), pygame.SRCALPHA)
+        self.rects = {}
+        x = 0
+        for name, image in images.items():
+            # Adding onto the transparent atlas copies the pixels, alpha included
+            self.rects[name] = self.surface.blit(image, (x, 0), special_flags=pygame.BLEND_RGBA_ADD)
+            x += image.get_width()
+        self.surface = self.surface.convert_alpha()
+        # Hold bodies are drawn as a slice of this column as tall as the screen
+        self.hold_body = pygame.Surface((max(1, round(HOLD_BODY_WIDTH * self.scale)), screen_height), pygame.SRCALPHA)
+        self.hold_body.fill(HOLD_BODY_COLOR)
+        self.hold_body = self.hold_body.convert_alpha()
+
+    def receptor(self, sprite):
+        return self.rects[f"{sprite}Receptor"]
+
+    def note(self, sprite):
+        return self.rects[f"{sprite}ReceptorD"]
 
 def get_centered_column_x(screen_width, num_columns, receptor_img_width):
     spacing = receptor_img_width + 20
     total_width = (num_columns - 1) * spacing
     start_x = (screen_width - total_width) // 2
-    return {DIRECTIONS[i]: start_x + i * spacing for i in range(num_columns)}
-
-def song_selection_menu(screen, font, big_font, json_files, song_titles):
+    return [start_x + i * spacing for i in range(num_columns)]
+
+def find_song(lowered, query, start):
+    # First title from start on (wrapping) starting with query, else containing it
+    order = list(range(start, len(lowered))) + list(range(start))
+    for i in order:
+        if lowered[i].startswith(query):
+            return i
+    for i in order:
+        if query in lowered[i]:
+            return i
+    return None
+
+def song_selection_menu(screen, font, big_font, json_files, song_titles, text_cache, score_store=None, on_highlight=None):
     selected = 0
+    highlighted = None
+    requested = None
+    stats_version = None
+    first_row = 0
+    query = ""
+    last_search_ticks = 0
+    search_titles = [title.lower() for title in song_titles]
+    visible_rows = max(1, (screen.get_height() - SONG_LIST_Y - 100) // SONG_ROW_HEIGHT)
     clock = pygame.time.Clock()
+    dirty = True
     while True:
-        screen.fill((0, 0, 0))
-        title_text = big_font.render("Select a Song", True, (255, 255, 255))
-        screen.blit(title_text, ((screen.get_width() - title_text.get_width()) // 2, 40))
-
-        if not json_files:
-            no_song_text = font.render("No songs found!", True, (255, 0, 0))
-            screen.blit(no_song_text, ((screen.get_width() - no_song_text.get_width()) // 2, 150))
-        else:
-            for i, title in enumerate(song_titles):
-                color = (255, 255, 0) if i == selected else (255, 255, 255)
-                text = font.render(title, True, color)
-                screen.blit(text, (100, 150 + i * 40))
-
-        instr = font.render("Use UP/DOWN to navigate, ENTER to select", True, (180, 180, 180))
-        screen.blit(instr, ((screen.get_width() - instr.get_width()) // 2, screen.get_height() - 60))
-
-        pygame.display.flip()
+        if on_highlight and json_files and highlighted != selected:
+            highlighted = selected
+            on_highlight(selected)
+
+        if score_store and json_files:
+            # Stats are loaded in the background and drawn once they arrive
+            if requested != json_files[selected]:
+                requested = json_files[selected]
+                score_store.request_stats(requested)
+            if stats_version != score_store.version:
+                stats_version = score_store.version
+                dirty = True
+
+        if dirty:
+            stats = score_store.stats.get(json_files[selected]) if score_store and json_files else None
+            draw_song_list(screen, font, big_font, json_files, song_titles, text_cache,
+                           selected, first_row, visible_rows, query, stats)
+            dirty = False
 
         for event in pygame.event.get():
+            dirty = True
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
-            elif event.type == pygame.KEYDOWN:
+            elif event.type == pygame.KEYDOWN and json_files:
                 if event.key == pygame.K_UP:
                     selected = (selected - 1) % len(json_files)
                 elif event.key == pygame.K_DOWN:
                     selected = (selected + 1) % len(json_files)
-                elif event.key == pygame.K_RETURN and json_files:
+                elif event.key == pygame.K_PAGEUP:
+                    selected = max(0, selected - visible_rows)
+                elif event.key == pygame.K_PAGEDOWN:
+                    selected = min(len(json_files) - 1, selected + visible_rows)
+                elif event.key == pygame.K_HOME:
+                    selected = 0
+                elif event.key == pygame.K_END:
+                    selected = len(json_files) - 1
+                elif event.key == pygame.K_RETURN:
                     return json_files[selected]
-
-        clock.tick(FPS)
-
-def get_judgment(distance):
+                elif event.key == pygame.K_BACKSPACE:
+                    query = query[:-1]
+                    last_search_ticks = pygame.time.get_ticks()
+                elif event.unicode and event.unicode.isprintable():
+                    now = pygame.time.get_ticks()
+                    if now - last_search_ticks > SEARCH_TIMEOUT_MS:
+                        query = ""
+                    last_search_ticks = now
+                    query += event.unicode.lower()
+                    # A new single letter jumps to the next title starting with it
+                    start = selected + 1 if len(query) == 1 else selected
+                    match = find_song(search_titles, query, start % len(song_titles))
+                    if match is not None:
+                        selected = match
+
+        # Keep the selection in view, only the rows in view are rendered
+        if selected < first_row:
+            first_row = selected
+        elif selected >= first_row + visible_rows:
+            first_row = selected - visible_rows + 1
+
+        if query and pygame.time.get_ticks() - last_search_ticks > SEARCH_TIMEOUT_MS:
+            query = ""
+            dirty = True
+
+        clock.tick(FPS if dirty else IDLE_FPS)
+
+def draw_song_list(screen, font, big_font, json_files, song_titles, text_cache,
+                   selected, first_row, visible_rows, query, stats=None):
+    screen.fill((0, 0, 0))
+    title_text = text_cache.render(big_font, "Select a Song", (255, 255, 255))
+    screen.blit(title_text, ((screen.get_width() - title_text.get_width()) // 2, 40))
+
+    if not json_files:
+        no_song_text = text_cache.render(font, "No songs found!", (255, 0, 0))
+        screen.blit(no_song_text, ((screen.get_width() - no_song_text.get_width()) // 2, SONG_LIST_Y))
+    else:
+        for i in range(first_row, min(first_row + visible_rows, len(song_titles))):
+            color = (255, 255, 0) if i == selected else (255, 255, 255)
+            text = text_cache.render(font, song_titles[i], color)
+            screen.blit(text, (100, SONG_LIST_Y + (i - first_row) * SONG_ROW_HEIGHT))
+
+        position = text_cache.render(font, f"{selected + 1}/{len(json_files)}", (180, 180, 180))
+        screen.blit(position, (screen.get_width() - position.get_width() - 100, SONG_LIST_Y - 40))
+        if query:
+            search_text = text_cache.render(font, f"Search: {query}", (180, 180, 180))
+            screen.blit(search_text, (100, SONG_LIST_Y - 40))
+        if stats:
+            draw_song_stats(screen, font, text_cache, stats)
+
+    instr = text_cache.render(font, "UP/DOWN/PGUP/PGDN to navigate, type to search, ENTER to select", (180, 180, 180))
+    screen.blit(instr, ((screen.get_width() - instr.get_width()) // 2, screen.get_height() - 60))
+
+    pygame.display.flip()
+
+def draw_song_stats(screen, font, text_cache, stats):
+    x = screen.get_width() * 11 // 20
+    lines = [(f"Plays: {stats['plays']}", (255, 255, 255))]
+    if stats['best_accuracy'] is not None:
+        lines.append((f"Best accuracy: {stats['best_accuracy']:.2f}%", (255, 255, 255)))
+    for rank, (score, accuracy, max_combo, played_at) in enumerate(stats['top'], 1):
+        lines.append((f"{rank}. {score}  {accuracy:.2f}%  x{max_combo}", (255, 255, 0) if rank == 1 else (200, 200, 200)))
+    offsets = [f"{offset:+.0f}" if offset is not None else "-" for offset in stats['lane_offsets']]
+    if any(offset is not None for offset in stats['lane_offsets']):
+        lines.append((f"Lane offsets (ms): {' '.join(offsets)}", (180, 180, 180)))
+    for i, (text, color) in enumerate(lines):
+        screen.blit(text_cache.render(font, text, color), (x, SONG_LIST_Y + i * SONG_ROW_HEIGHT))
+
+def load_keymaps():
+    # {key count: {key code: lane}}, the defaults unless KEYMAP_FILE lists other key names
+    custom = {}
+    try:
+        with open(KEYMAP_FILE, 'r') as f:
+            custom = {int(keys): lane_keys for keys, lane_keys in json.load(f).items()}
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"Error reading keymaps: {e}")
+
+    keymaps = {}
+    for keys, default in DEFAULT_KEYMAPS.items():
+        lane_keys = custom.get(keys, default)
+        try:
+            if len(lane_keys) != keys:
+                raise ValueError(f"expected {keys} keys, got {len(lane_keys)}")
+            keymaps[keys] = {pygame.key.key_code(name): lane for lane, name in enumerate(lane_keys)}
+        except (TypeError, ValueError) as e:
+            print(f"Error in {keys}K keymap, using the default: {e}")
+            keymaps[keys] = {pygame.key.key_code(name): lane for lane, name in enumerate(default)}
+    return keymaps
+
+def load_calibration():
+    calibration = {'audio_offset': 0, 'visual_offset': 0}
+    try:
+        with open(CALIBRATION_FILE, 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return calibration
+    # Whole ms, the file may have been edited by hand
+    for key in calibration:
+        try:
+            calibration[key] = int(saved.get(key, 0))
+        except (TypeError, ValueError, OverflowError, AttributeError):
+            pass
+    return calibration
+
+def save_calibration(calibration):
+    try:
+        with open(CALIBRATION_FILE, 'w') as f:
+            json.dump(calibration, f)
+    except OSError as e:
+        print(f"Error saving calibration: {e}")
+
+def make_click_sound():
+    # Short decaying square wave in the mixer's sample format
+    freq, size, channels = pygame.mixer.get_init()
+    if abs(size) == 16:
+        typecode, amplitude = 'h', 12000
+    elif abs(size) == 32:
+        typecode, amplitude = 'f', 0.4
+    else:
+        return None
+    samples = int(freq * 0.03)
+    wave = array(typecode)
+    for i in range(samples):
+        value = amplitude * (1 - i / samples) * (1 if i * 2000 // freq % 2 else -1)
+        wave.extend([type(amplitude)(value)] * channels)
+    return pygame.mixer.Sound(buffer=wave.tobytes())
+
+def calibration_screen(screen, font, big_font, text_cache, calibration):
+    # Tap SPACE along with a click, then along with a flash. The median tap
+    # offsets are the audio and visual latency of this machine. Returns the
+    # new calibration, or None when cancelled with ESC.
+    click = make_click_sound() if pygame.mixer.get_init() else None
+    calibration = dict(calibration)
+    clock = pygame.time.Clock()
+    frame_interval = 1000 / FPS
+    for phase in ('audio', 'visual'):
+        offsets = []
+        start = get_time_ms() + CALIBRATION_INTERVAL_MS
+        last_beat = -1
+        next_frame = 0
+        while len(offsets) < CALIBRATION_TAPS:
+            clock.tick(INPUT_HZ)
+            now = get_time_ms() - start
+            beat = int(now // CALIBRATION_INTERVAL_MS) if now >= 0 else -1
+            if beat > last_beat:
+                last_beat = beat
+                if phase == 'audio' and click:
+                    click.play()
+
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    sys.exit()
+                elif event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        return None
+                    elif event.key == pygame.K_SPACE and now >= 0:
+                        tap = get_time_ms() - start
+                        nearest = round(tap / CALIBRATION_INTERVAL_MS) * CALIBRATION_INTERVAL_MS
+                        offsets.append(tap - nearest)
+
+            if now < next_frame:
+                continue
+            next_frame = now + frame_interval
+            screen.fill((0, 0, 0))
+            title = text_cache.render(big_font, f"Calibration: {phase}", (255, 255, 255))
+            screen.blit(title, ((screen.get_width() - title.get_width()) // 2, 40))
+            if phase == 'audio':
+                instr_text = "Tap SPACE on every click"
+            else:
+                instr_text = "Tap SPACE every time the square flashes"
+                if beat >= 0 and now - beat * CALIBRATION_INTERVAL_MS < 80:
+                    size = 120
+                    pygame.draw.rect(screen, (255, 255, 255), ((screen.get_width() - size) // 2, (screen.get_height() - size) // 2, size, size))
+            instr = text_cache.render(font, instr_text, (255, 255, 0))
+            screen.blit(instr, ((screen.get_width() - instr.get_width()) // 2, screen.get_height() // 4))
+            taps = text_cache.render(font, f"{len(offsets)}/{CALIBRATION_TAPS}  (ESC to cancel)", (180, 180, 180))
+            screen.blit(taps, ((screen.get_width() - taps.get_width()) // 2, screen.get_height() - 60))
+            pygame.display.flip()
+
+        offsets.sort()
+        calibration[f'{phase}_offset'] = int(round(offsets[len(offsets) // 2]))
+
+    save_calibration(calibration)
+    return calibration
+
+def get_judgment(offset_ms):
+    distance = abs(offset_ms)
     if distance <= HIT_WINDOWS['sick']:
         return 'sick'
     elif distance <= HIT_WINDOWS['good']:
@@ -119,6 +986,776 @@ def get_judgment(distance):
         return 'trash'
     return 'miss'
 
+def update_multiplier(combo):
+    if combo >= 50:
+        return 2.0
+    elif combo >= 30:
+        return 1.5
+    elif combo >= 15:
+        return 1.2
+    else:
+        return 1.0
+
+class Game:
+    # Notes, scoring and health for one play of a chart, driven by the song
+    # time in ms so it runs the same with a display, headless or in a replay
+    def __init__(self, note_times, note_masks, px_per_ms, keys=DEFAULT_KEYS, note_pool=None, stream=None):
+        self.note_times = note_times
+        self.note_masks = note_masks
+        # ChartStream still appending to note_times and note_masks, spawning
+        # only looks at the rows compiled so far
+        self.stream = stream
+        self.px_per_ms = px_per_ms
+        self.keys = keys
+        self.lead_time = get_lead_time(px_per_ms)
+        self.note_pool = note_pool or NotePool()
+        # Pending notes of each lane number, in hit time order
+        self.notes = [deque() for _ in range(keys)]
+        # Per lane, the hold being held down, and the hold whose tail hasn't spawned yet
+        self.holding = [None] * keys
+        self.open_holds = [None] * keys
+        self.next_note_index = 0
+        self.score = 0
+        self.combo = 0
+        self.max_combo = 0
+        self.multiplier = 1.0
+        self.health = HEALTH_MAX
+        self.hit_counts = {k: 0 for k in list(HIT_WINDOWS.keys()) + ['miss']}
+        self.spawned = 0
+        self.judged = 0
+        self.despawned = 0
+        # Per-lane histogram of hit offsets, bins TIMING_BIN_MS wide centred on -trash to +trash
+        self.timing_errors = [[0] * (2 * HIT_WINDOWS['trash'] // TIMING_BIN_MS + 1) for _ in range(keys)]
+        # Key events for the replay, song time in ms and lane | REPLAY_KEY_DOWN
+        self.input_times = array('i')
+        self.input_codes = array('B')
+
+    def release_notes(self):
+        for lane in self.notes:
+            while lane:
+                self.note_pool.release(lane.pop())
+        for lane, note in enumerate(self.holding):
+            if note is not None:
+                self.holding[lane] = None
+                self.note_pool.release(note)
+
+    def release(self, note):
+        if self.open_holds[note.lane] is note:
+            # Its tail no longer has anything to end
+            self.open_holds[note.lane] = None
+        self.note_pool.release(note)
+
+    def spawn(self, now):
+        # Spawn notes that are about to scroll into view
+        note_times = self.note_times
+        while self.next_note_index < len(note_times) and note_times[self.next_note_index] - self.lead_time <= now:
+            mask = self.note_masks[self.next_note_index]
+            hit_time = note_times[self.next_note_index]
+            # Only the set bits are visited, so dense rows of many lanes stay cheap
+            while mask:
+                bit = (mask & -mask).bit_length() - 1
+                mask &= mask - 1
+                lane = bit % HOLD_HEAD_SHIFT
+                if bit >= HOLD_TAIL_SHIFT:
+                    note = self.open_holds[lane]
+                    if note is not None:
+                        note.end_time = hit_time
+                        self.open_holds[lane] = None
+                    continue
+                note = self.note_pool.acquire(lane, hit_time, bit >= HOLD_HEAD_SHIFT)
+                if note.hold:
+                    self.open_holds[lane] = note
+                self.notes[lane].append(note)
+                self.spawned += 1
+            self.next_note_index += 1
+
+    def press(self, lane, now):
+        # Judge a key press at song time now against the head of its lane.
+        # Notes are spawned and expired up to now first, so the outcome only
+        # depends on the input times and replays are deterministic.
+        now = math.floor(now)
+        self.input_times.append(now)
+        self.input_codes.append(lane | REPLAY_KEY_DOWN)
+        self.spawn(now)
+        self.update(now)
+        notes = self.notes[lane]
+        offset = now - notes[0].hit_time if notes else None
+        if offset is None or abs(offset) > HIT_WINDOWS['trash']:
+            # Missed key press
+            self.miss()
+            return 'miss'
+
+        note = notes.popleft()
+        if note.hold:
+            # Judged again when the key is let go
+            self.holding[lane] = note
+        else:
+            self.release(note)
+        self.timing_errors[lane][(offset + HIT_WINDOWS['trash'] + TIMING_BIN_MS // 2) // TIMING_BIN_MS] += 1
+        return self.judge(offset)
+
+    def judge(self, offset):
+        judgment = get_judgment(offset)
+        self.hit_counts[judgment] += 1
+        if judgment == 'sick':
+            self.score += int(300 * self.multiplier)
+            self.combo += 1
+        elif judgment == 'good':
+            self.score += int(200 * self.multiplier)
+            self.combo += 1
+        elif judgment == 'bad':
+            self.score += int(100 * self.multiplier)
+            self.combo = 0
+        elif judgment == 'trash':
+            self.score += int(50 * self.multiplier)
+            self.combo = 0
+
+        if self.combo > self.max_combo:
+            self.max_combo = self.combo
+        self.multiplier = update_multiplier(self.combo)
+        self.health = min(HEALTH_MAX, self.health + 1)
+        self.judged += 1
+        return judgment
+
+    def key_up(self, lane, now):
+        # Ends a hold of this lane, judged against its tail. Letting go
+        # before the tail's hit window is a miss.
+        now = math.floor(now)
+        self.input_times.append(now)
+        self.input_codes.append(lane)
+        self.spawn(now)
+        self.update(now)
+        note = self.holding[lane]
+        if note is None:
+            return None
+        self.holding[lane] = None
+        self.release(note)
+        if note.end_time is None or note.end_time - now > HIT_WINDOWS['trash']:
+            self.miss()
+            return 'miss'
+        return self.judge(now - note.end_time)
+
+    def miss(self):
+        self.hit_counts['miss'] += 1
+        self.combo = 0
+        self.health -= 10
+
+    def update(self, now):
+        # Expires notes past the last hit window and completes holds held
+        # through their tails, one at a time in time order and not after a
+        # failure, so the outcome doesn't depend on how often this is called.
+        # Whole ms like press, so live and replayed plays see the same times.
+        now = math.floor(now)
+        while not self.failed():
+            event_time = None
+            for lane, notes in enumerate(self.notes):
+                if notes:
+                    expiry_time = notes[0].hit_time + HIT_WINDOWS['trash'] + 1
+                    if event_time is None or expiry_time < event_time:
+                        event_time, event_lane, expiry = expiry_time, lane, True
+            for lane, note in enumerate(self.holding):
+                if note is not None and note.end_time is not None and (event_time is None or note.end_time < event_time):
+                    event_time, event_lane, expiry = note.end_time, lane, False
+            if event_time is None or event_time > now:
+                break
+            if expiry:
+                self.release(self.notes[event_lane].popleft())
+                self.despawned += 1
+                self.miss()
+            else:
+                note = self.holding[event_lane]
+                self.holding[event_lane] = None
+                self.release(note)
+                self.judge(0)
+
+    def failed(self):
+        return self.health <= 0
+
+    def notes_left(self):
+        return (self.next_note_index < len(self.note_times) or any(self.notes) or any(self.holding)
+                or (self.stream is not None and not self.stream.done))
+
+    def accuracy(self):
+        total_hits = sum(self.hit_counts[k] for k in ['sick', 'good', 'bad', 'trash'])
+        if total_hits == 0:
+            return 0
+        return (self.hit_counts['sick'] + 0.7 * self.hit_counts['good'] + 0.4 * self.hit_counts['bad'] + 0.1 * self.hit_counts['trash']) / total_hits * 100
+
+class GameView:
+    # Draws a Game and keeps the purely visual state: hit text fade and fire animation
+    def __init__(self, width, height, font, big_font, text_cache, effects, atlas):
+        self.width = width
+        self.height = height
+        self.font = font
+        self.big_font = big_font
+        self.text_cache = text_cache
+        self.effects = effects
+        self.atlas = atlas
+        self.scale = atlas.scale
+        self.receptor_y = int(RECEPTOR_Y * self.scale)
+        self.set_keys(DEFAULT_KEYS)
+        self.reset()
+
+    def set_keys(self, keys):
+        # Lane layout for a chart of this many keys
+        self.keys = keys
+        sprites = LANE_SPRITES[keys]
+        atlas = self.atlas
+        self.column_x = get_centered_column_x(self.width, keys, atlas.receptor(sprites[0]).width)
+        # Per lane source rect in the atlas and offset from a note's centre to its top left
+        self.receptor_blits = []
+        self.note_areas = []
+        self.note_offsets = []
+        for x, sprite in zip(self.column_x, sprites):
+            area = atlas.receptor(sprite)
+            self.receptor_blits.append((atlas.surface, (x - area.width // 2, self.receptor_y - area.height // 2), area))
+            area = atlas.note(sprite)
+            self.note_areas.append(area)
+            self.note_offsets.append((x - area.width // 2, area.height // 2))
+
+    def reset(self):
+        self.hit_display_text = ""
+        self.hit_display_count = 0
+        self.hit_display_timer = 0
+        self.hit_display_alpha = 0
+        self.fire_anim_frame = 0
+        self.fire_text_glow = 0
+        self.fire_active = False
+
+    def show_judgment(self, judgment):
+        # Display hit text and count
+        if judgment == self.hit_display_text:
+            self.hit_display_count += 1
+        else:
+            self.hit_display_text = judgment
+            self.hit_display_count = 1
+        self.hit_display_timer = 30  # frames
+
+    def tick(self, combo):
+        # Update fire effect
+        self.fire_active = combo >= FIRE_COMBO_THRESHOLD
+        if self.fire_active:
+            self.fire_anim_frame = (self.fire_anim_frame + 1) % len(fire_colors)
+            self.fire_text_glow = min(255, self.fire_text_glow + 25)
+        else:
+            self.fire_text_glow = max(0, self.fire_text_glow - 25)
+
+    def begin(self, renderer):
+        if self.fire_active:
+            renderer.begin(full=True, background=self.effects.fire_background(self.fire_anim_frame))
+        else:
+            renderer.begin()
+
+    def draw(self, renderer, game, now, progress_ratio=None):
+        # Note positions are only needed here, at the render rate
+        text_cache = self.text_cache
+        font = self.font
+        px_per_ms = game.px_per_ms
+
+        # Draw receptors and notes as one batch from the atlas, each hold
+        # body as a single blit of a slice of the body column
+        surface = self.atlas.surface
+        body = self.atlas.hold_body
+        body_width = body.get_width()
+        scale = self.scale
+        blits = list(self.receptor_blits)
+        for area, (x, half_height), notes, held in zip(self.note_areas, self.note_offsets, game.notes, game.holding):
+            body_x = x + (area.width - body_width) // 2
+            if held is not None:
+                # Held notes stay on the receptor while their body shrinks into it
+                held.y = RECEPTOR_Y
+                notes = chain((held,), notes)
+            for note in notes:
+                if note is not held:
+                    note.update(now, px_per_ms)
+                y = int(note.y * scale)
+                if note.hold:
+                    # Up to the top of the screen while the tail isn't spawned
+                    top = 0 if note.end_time is None else max(0, int((RECEPTOR_Y - (note.end_time - now) * px_per_ms) * scale))
+                    if y > top:
+                        blits.append((body, (body_x, top), (0, 0, body_width, y - top)))
+                blits.append((surface, (x, y - half_height), area))
+        renderer.blits(blits)
+
+        # Draw combo
+        combo_color = (255, 255, 255)
+        combo_scale = 1.0
+        if self.fire_active:
+            combo_color = fire_colors[self.fire_anim_frame]
+            combo_scale = 1.2 + 0.1 * (self.fire_anim_frame % 2)
+        combo_text_surface = text_cache.render(font, f"Combo: {game.combo}", combo_color)
+        if self.fire_active:
+            glow_size = (combo_text_surface.get_width()+8, combo_text_surface.get_height()+8)
+            renderer.blit(self.effects.glow(glow_size, combo_color, min(180, self.fire_text_glow)), (6, 36))
+        if combo_scale != 1.0:
+            combo_text_surface = text_cache.render(font, f"Combo: {game.combo}", combo_color, combo_scale)
+        renderer.blit(combo_text_surface, (10, 40))
+
+        # Draw health bar
+        health_bar_width = 400
+        health_bar_height = 25
+        health_ratio = max(0, game.health) / HEALTH_MAX
+        renderer.draw_rect((150, 0, 0), (self.width - health_bar_width - 20, 20, health_bar_width, health_bar_height))
+        renderer.draw_rect((0, 200, 0), (self.width - health_bar_width - 20, 20, int(health_bar_width * health_ratio), health_bar_height))
+
+        # Draw score and multiplier
+        score_text = text_cache.render(font, f"Score: {game.score}", (255, 255, 255))
+        multiplier_text = text_cache.render(font, f"Multiplier: x{game.multiplier:.1f}", (255, 255, 255))
+        renderer.blit(score_text, (10, 10))
+        renderer.blit(multiplier_text, (10, 70))
+
+        # Fire label
+        if self.fire_active:
+            fire_label = text_cache.render(self.big_font, "FIRE!", fire_colors[self.fire_anim_frame])
+            fire_label.set_alpha(200)
+            fx = (self.width - fire_label.get_width()) // 2
+            fy = 120
+            renderer.blit(fire_label, (fx, fy))
+
+        # Pause hint
+        pause_hint = text_cache.render(font, "Press ESC to Pause/Resume", (180, 180, 180))
+        renderer.blit(pause_hint, (self.width - pause_hint.get_width() - 20, self.height - 40))
+
+        # Hit display text
+        if self.hit_display_timer > 0 and self.hit_display_text:
+            display_text = self.hit_display_text.upper()
+            if self.hit_display_count > 1:
+                display_text += f" x{self.hit_display_count}"
+            hit_text = text_cache.render(self.big_font, display_text, (255, 255, 255))
+            hit_text.set_alpha(self.hit_display_alpha)
+            hit_x = self.column_x[0] - 180
+            hit_y = self.receptor_y - 50
+            renderer.blit(hit_text, (hit_x, hit_y))
+
+            fade_duration = 7  # frames to fade
+            if self.hit_display_timer > 30 - fade_duration:
+                self.hit_display_alpha = int(255 * (1 - (self.hit_display_timer - (30 - fade_duration)) / fade_duration))
+            elif self.hit_display_timer < fade_duration:
+                self.hit_display_alpha = int(255 * (self.hit_display_timer / fade_duration))
+            else:
+                self.hit_display_alpha = 255
+            self.hit_display_timer -= 1
+        else:
+            self.hit_display_text = ""
+            self.hit_display_count = 0
+            self.hit_display_alpha = 0
+
+        # Progress bar (optional)
+        if progress_ratio is not None:
+            bar_width = 400
+            bar_height = 15
+            x = (self.width - bar_width) // 2
+            y = 10
+            renderer.draw_rect((100, 100, 100), (x, y, bar_width, bar_height))
+            renderer.draw_rect((50, 200, 50), (x, y, int(bar_width * progress_ratio), bar_height))
+
+def get_chart_hash(note_times, note_masks):
+    h = hashlib.sha1()
+    h.update(note_times)
+    h.update(note_masks)
+    return h.hexdigest()
+
+def get_results(game):
+    return {
+        'score': game.score,
+        'max_combo': game.max_combo,
+        'hit_counts': game.hit_counts,
+        'failed': game.failed(),
+    }
+
+def save_replay(game, chart_path, note_speed):
+    meta = {
+        'chart': chart_path,
+        'chart_hash': get_chart_hash(game.note_times, game.note_masks),
+        'note_speed': note_speed,
+        'recorded_at': int(time.time()),
+        'results': get_results(game),
+    }
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    meta_bytes += b' ' * (-(REPLAY_HEADER.size + len(meta_bytes)) % 4)
+    header = REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, sys.byteorder == 'little',
+                                len(game.input_times), len(meta_bytes))
+    name = os.path.splitext(os.path.basename(chart_path))[0]
+    path = os.path.join(REPLAY_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.pysr")
+    try:
+        os.makedirs(REPLAY_DIR, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(meta_bytes)
+            game.input_times.tofile(f)
+            game.input_codes.tofile(f)
+    except OSError as e:
+        print(f"Error saving replay: {e}")
+        return None
+    return path
+
+def load_replay(path):
+    # Returns (metadata, input times, input codes)
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, little, count, meta_len = REPLAY_HEADER.unpack_from(data)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError(f"{path} is not a supported replay")
+    offset = REPLAY_HEADER.size
+    meta = json.loads(data[offset:offset + meta_len])
+    offset += meta_len
+    input_times = array('i', data[offset:offset + count * 4])
+    input_codes = array('B', data[offset + count * 4:offset + count * 5])
+    if little != (sys.byteorder == 'little'):
+        input_times.byteswap()
+    return meta, input_times, input_codes
+
+def simulate_replay(note_times, note_masks, note_speed, input_times, input_codes, keys=DEFAULT_KEYS):
+    # Re-runs the scoring of a play from its key events, without a display
+    game = Game(note_times, note_masks, get_scroll_speed(note_speed), keys)
+    for now, code in zip(input_times, input_codes):
+        if game.failed():
+            break
+        lane = code & ~REPLAY_KEY_DOWN
+        if code & REPLAY_KEY_DOWN:
+            game.press(lane, now)
+        else:
+            game.key_up(lane, now)
+    # Whatever is left was missed or held to its tail, update goes through
+    # those expiries and tails in time order like the live loop
+    if len(note_times) and not game.failed():
+        game.spawn(note_times[-1])
+        game.update(note_times[-1] + HIT_WINDOWS['trash'] + 1)
+    return game
+
+def verify_replay(path):
+    # Re-simulates a replay against its chart with the current hit windows.
+    # Module level so it can be handed to a process pool.
+    try:
+        meta, input_times, input_codes = load_replay(path)
+        chart_meta, note_times, note_masks = load_chart(meta['chart'])
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        return {'replay': path, 'ok': False, 'error': str(e)}
+    if get_chart_hash(note_times, note_masks) != meta['chart_hash']:
+        return {'replay': path, 'ok': False, 'error': "chart has changed since the replay was recorded"}
+    game = simulate_replay(note_times, note_masks, meta['note_speed'], input_times, input_codes, chart_meta['keys'])
+    results = get_results(game)
+    return {'replay': path, 'ok': results == meta['results'], 'claimed': meta['results'], 'results': results}
+
+class ScoreStore:
+    # SQLite score database owned by one background thread. Results are queued
+    # and written in batches, and stats queries run on the same thread with
+    # their answers left in self.stats, so neither ever blocks a frame.
+    def __init__(self, path=SCORE_DB):
+        self.path = path
+        self.requests = queue.Queue()
+        self.stats = {}
+        self.version = 0
+        self.thread = threading.Thread(target=self.run, name='score-store', daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        self.requests.put(('write', record))
+
+    def request_stats(self, chart):
+        self.requests.put(('stats', chart))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.requests.put(('close', None))
+            self.thread.join()
+
+    def run(self):
+        try:
+            db = sqlite3.connect(self.path)
+            db.execute("""CREATE TABLE IF NOT EXISTS plays (
+                id INTEGER PRIMARY KEY,
+                chart TEXT NOT NULL,
+                chart_hash TEXT,
+                played_at INTEGER,
+                score INTEGER,
+                accuracy REAL,
+                max_combo INTEGER,
+                failed INTEGER,
+                hit_counts TEXT,
+                timing_errors TEXT,
+                replay TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS plays_chart_score ON plays (chart, score DESC)")
+            db.execute("CREATE INDEX IF NOT EXISTS plays_chart_played ON plays (chart, played_at DESC)")
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Error opening score database: {e}")
+            return
+
+        running = True
+        while running:
+            kind, value = self.requests.get()
+            writes = []
+            while True:
+                if kind == 'write':
+                    writes.append(value)
+                elif kind == 'stats':
+                    self.write_batch(db, writes)
+                    writes = []
+                    self.load_stats(db, value)
+                else:
+                    running = False
+                    break
+                if len(writes) >= SCORE_BATCH_SIZE:
+                    break
+                try:
+                    kind, value = self.requests.get(timeout=SCORE_BATCH_WAIT if writes else 0)
+                except queue.Empty:
+                    break
+            self.write_batch(db, writes)
+        db.close()
+
+    def write_batch(self, db, records):
+        if not records:
+            return
+        rows = [(r['chart'], r['chart_hash'], r['played_at'], r['score'], r['accuracy'], r['max_combo'],
+                 r['failed'], json.dumps(r['hit_counts']), json.dumps(r['timing_errors']), r['replay'])
+                for r in records]
+        try:
+            with db:
+                db.executemany("""INSERT INTO plays (chart, chart_hash, played_at, score, accuracy, max_combo,
+                                  failed, hit_counts, timing_errors, replay) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+        except sqlite3.Error as e:
+            print(f"Error saving scores: {e}")
+            return
+        # Cached stats of these charts are out of date now
+        for record in records:
+            if record['chart'] in self.stats:
+                self.load_stats(db, record['chart'])
+
+    def load_stats(self, db, chart):
+        try:
+            top = db.execute("""SELECT score, accuracy, max_combo, played_at FROM plays
+                                WHERE chart = ? ORDER BY score DESC LIMIT ?""", (chart, LEADERBOARD_SIZE)).fetchall()
+            plays, best_accuracy = db.execute("SELECT COUNT(*), MAX(accuracy) FROM plays WHERE chart = ?",
+                                              (chart,)).fetchone()
+            recent = db.execute("""SELECT timing_errors FROM plays WHERE chart = ?
+                                   ORDER BY played_at DESC LIMIT 20""", (chart,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error reading scores: {e}")
+            return
+        # Mean hit offset per lane over the recent plays
+        histograms = [json.loads(errors) for (errors,) in recent]
+        lane_offsets = []
+        for lane in range(max(map(len, histograms), default=0)):
+            total = count = 0
+            for lanes in histograms:
+                histogram = lanes[lane] if lane < len(lanes) else []
+                for i, n in enumerate(histogram):
+                    total += n * (i * TIMING_BIN_MS - HIT_WINDOWS['trash'])
+                    count += n
+            lane_offsets.append(total / count if count else None)
+        self.stats[chart] = {'top': top, 'plays': plays, 'best_accuracy': best_accuracy, 'lane_offsets': lane_offsets}
+        self.version += 1
+
+def get_score_record(game, chart_path, replay_path):
+    record = get_results(game)
+    record.update({
+        'chart': chart_path,
+        'chart_hash': get_chart_hash(game.note_times, game.note_masks),
+        'played_at': int(time.time()),
+        'accuracy': game.accuracy(),
+        'timing_errors': game.timing_errors,
+        'replay': replay_path,
+    })
+    return record
+
+def get_autoplay_inputs(note_times, note_masks, offset=0):
+    # (time_ms, lane) presses hitting every note, offset ms from its hit time.
+    # Keys are never let go, so holds last until their tails.
+    inputs = []
+    for hit_time, mask in zip(note_times, note_masks):
+        mask &= (1 << HOLD_TAIL_SHIFT) - 1
+        while mask:
+            inputs.append((hit_time + offset, ((mask & -mask).bit_length() - 1) % HOLD_HEAD_SHIFT))
+            mask &= mask - 1
+    return inputs
+
+def run_headless(chart, inputs=None, size=(1280, 720), fps=FPS, render=True):
+    # Plays a (meta, times, masks) chart on the SDL dummy drivers as fast as
+    # possible, with a simulated clock stepping 1000 / fps ms per frame. Inputs
+    # are (time_ms, lane) presses in time order, autoplay when None.
+    # Returns per-frame update/render timings in ms and the play's counters.
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pygame.init()
+    screen = pygame.display.set_mode(size)
+    width, height = size
+
+    meta, note_times, note_masks = chart
+    px_per_ms = get_scroll_speed(meta.get('noteSpeed', 15))
+    if inputs is None:
+        inputs = get_autoplay_inputs(note_times, note_masks)
+
+    keys = meta.get('keys', DEFAULT_KEYS)
+    game = Game(note_times, note_masks, px_per_ms, keys)
+    renderer = DirtyRenderer(screen)
+    view = GameView(width, height, pygame.font.SysFont(None, 36), pygame.font.SysFont(None, 48),
+                    TextCache(), EffectCache(), SpriteAtlas(AssetManager(), height))
+    view.set_keys(keys)
+
+    update_times = array('d')
+    render_times = array('d')
+    frame_ms = 1000 / fps
+    now = -game.lead_time
+    next_input = 0
+    while (game.notes_left() or next_input < len(inputs)) and not game.failed():
+        start = time.perf_counter()
+        game.spawn(now)
+        while next_input < len(inputs) and inputs[next_input][0] <= now:
+            input_time, lane = inputs[next_input]
+            judgment = game.press(lane, input_time)
+            if judgment != 'miss':
+                view.show_judgment(judgment)
+            next_input += 1
+        game.update(now)
+        view.tick(game.combo)
+        updated = time.perf_counter()
+        if render:
+            view.begin(renderer)
+            view.draw(renderer, game, now)
+            renderer.end()
+        update_times.append((updated - start) * 1000)
+        render_times.append((time.perf_counter() - updated) * 1000)
+        now += frame_ms
+
+    game.release_notes()
+    return {
+        'frames': len(update_times),
+        'update_ms': update_times,
+        'render_ms': render_times,
+        'spawned': game.spawned,
+        'judged': game.judged,
+        'despawned': game.despawned,
+        'score': game.score,
+        'max_combo': game.max_combo,
+        'hit_counts': game.hit_counts,
+    }
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class PerfMonitor:
+    # Timings of the main loop while playing. The time of each PERF_PHASES
+    # phase is summed over the loop iterations up to a drawn frame, which is
+    # then one sample of the rolling HUD stats and the optional log.
+    def __init__(self, hud=PERF_HUD, log_path=PERF_LOG):
+        self.hud = hud
+        self.log_path = log_path
+        self.log = [] if log_path else None
+        self.window = deque(maxlen=PERF_WINDOW)
+        self.phase_ms = [0.0] * len(PERF_PHASES)
+        self.last = get_time_ms()
+        self.last_frame = None
+        self.profiler = None
+        self.profile_left = 0
+        # Finished captures, only written out once the song is over
+        self.profiles = []
+        self.hud_lines = []
+        self.hud_refresh = 0
+
+    def restart(self):
+        # Play starts or resumes, time spent before isn't part of any frame
+        self.phase_ms = [0.0] * len(PERF_PHASES)
+        self.last = get_time_ms()
+        self.last_frame = None
+
+    def begin(self):
+        self.last = get_time_ms()
+
+    def phase(self, index):
+        now = get_time_ms()
+        self.phase_ms[index] += now - self.last
+        self.last = now
+
+    def frame(self, game):
+        # Called once a frame is on screen
+        now = get_time_ms()
+        if self.last_frame is not None:
+            on_screen = sum(map(len, game.notes))
+            held = sum(note is not None for note in game.holding)
+            sample = (now - self.last_frame, *self.phase_ms, on_screen, held, game.spawned, game.judged)
+            self.window.append(sample)
+            if self.log is not None:
+                self.log.append((round(now), *sample))
+        self.last_frame = now
+        self.phase_ms = [0.0] * len(PERF_PHASES)
+        if self.profiler:
+            self.profile_left -= 1
+            if self.profile_left <= 0:
+                self.stop_profile()
+
+    def start_profile(self, frames=PROFILE_FRAMES):
+        if self.profiler:
+            return
+        self.profiler = cProfile.Profile()
+        self.profile_left = frames
+        self.profiler.enable()
+
+    def stop_profile(self):
+        self.profiler.disable()
+        self.profiles.append(self.profiler)
+        self.profiler = None
+
+    def save_profiles(self):
+        # Outside of play, writing them out would stutter the frames being measured
+        if self.profiler:
+            self.stop_profile()
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        for i, profiler in enumerate(self.profiles, 1):
+            path = os.path.join(PROFILE_DIR, f"profile-{stamp}-{i}.prof")
+            try:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                profiler.dump_stats(path)
+            except OSError as e:
+                print(f"Error saving profile: {e}")
+                continue
+            print(f"Profile saved to {path}")
+        self.profiles = []
+
+    def draw(self, renderer, font, text_cache):
+        if not self.hud:
+            return
+        # The text only changes a few times a second, so it stays readable and cached
+        ticks = get_time_ms()
+        if ticks >= self.hud_refresh and self.window:
+            self.hud_refresh = ticks + PERF_HUD_REFRESH_MS
+            frame_ms = [sample[0] for sample in self.window]
+            phases = [sum(sample[1 + i] for sample in self.window) / len(self.window) for i in range(len(PERF_PHASES))]
+            on_screen, held, spawned, judged = self.window[-1][-4:]
+            self.hud_lines = [
+                f"FPS {1000 * len(frame_ms) / sum(frame_ms):.1f}  frame p50 {percentile(frame_ms, 50):.1f}"
+                f"  p95 {percentile(frame_ms, 95):.1f}  p99 {percentile(frame_ms, 99):.1f} ms",
+                "  ".join(f"{name} {ms:.2f}" for name, ms in zip(PERF_PHASES, phases)) + " ms/frame",
+                f"notes {on_screen} on screen, {held} held, {spawned} spawned, {judged} judged",
+            ]
+        lines = self.hud_lines
+        if self.profiler:
+            lines = lines + [f"profiling, {self.profile_left} frames left"]
+        for i, line in enumerate(lines):
+            renderer.blit(text_cache.render(font, line, (120, 255, 120)), (10, 110 + i * 24))
+
+    def close(self):
+        self.save_profiles()
+        if not self.log:
+            return
+        columns = ['time_ms', 'frame_ms'] + [f"{name}_ms" for name in PERF_PHASES] + ['on_screen', 'held', 'spawned', 'judged']
+        try:
+            with open(self.log_path, 'w', newline='') as f:
+                if self.log_path.endswith('.json'):
+                    json.dump([dict(zip(columns, row)) for row in self.log], f)
+                else:
+                    writer = csv.writer(f)
+                    writer.writerow(columns)
+                    writer.writerows(self.log)
+        except OSError as e:
+            print(f"Error writing performance log: {e}")
+        self.log = []
+
 def main():
     pygame.init()
     pygame.mixer.init()
@@ -131,134 +1768,116 @@ def main():
 
     font = pygame.font.SysFont(None, 36)
     big_font = pygame.font.SysFont(None, 48)
+    hud_font = pygame.font.SysFont(None, 24)
     clock = pygame.time.Clock()
+    text_cache = TextCache()
+    renderer = DirtyRenderer(screen)
+    score_store = ScoreStore()
+    atexit.register(score_store.close)
+    perf = PerfMonitor()
+    atexit.register(perf.close)
+    effects = EffectCache()
 
-    # List JSON song files
-    json_files = list_json_files()
-    song_titles = [get_song_title(f) for f in json_files]
+    assets = AssetManager()
 
-    selected_json_file = song_selection_menu(screen, font, big_font, json_files, song_titles)
+    def preload_song(index):
+        assets.preload_audio(songs[index].get('song'))
 
-    # Load song data from JSON
-    with open(selected_json_file, 'r') as f:
-        song_data = json.load(f)
+    # List JSON song files
+    songs = load_song_library()
+    json_files = [song['path'] for song in songs]
+    song_titles = [get_song_label(song) for song in songs]
 
-    music_sheet_raw = song_data.get('musicSheet', [])
-    song_path = song_data.get('song', None)
-    bpm = song_data.get('bpm', 120)
+    selected_json_file = song_selection_menu(screen, font, big_font, json_files, song_titles, text_cache, score_store, preload_song)
+
+    # Load the compiled chart, long line-delimited ones are still read while playing
+    song_data, note_times, note_masks, chart_stream = open_chart(selected_json_file)
+    selected_title = song_titles[json_files.index(selected_json_file)]
+    song_path = resolve_song_path(selected_json_file, song_data.get('song'))
     note_speed = song_data.get('noteSpeed', 15)
 
-    receptors, note_images = load_images()
-    receptor_img_width = receptors[DIRECTIONS[0]].get_width()
-    COLUMN_X = get_centered_column_x(SCREEN_WIDTH, len(DIRECTIONS), receptor_img_width)
-
-    # Precalculate note spawn times in ms based on bpm
-    beat_interval_ms = 60000 / bpm
-    music_sheet_raw = song_data.get('musicSheet', [])
-    music_sheet = music_sheet_raw
-
-    # Game variables
-    notes = []
-    next_note_index = 0
-    score = 0
-    combo = 0
-    max_combo = 0
-    multiplier = 1.0
-    health = HEALTH_MAX
-    hit_counts = {k: 0 for k in list(HIT_WINDOWS.keys()) + ['miss']}
+    calibration = load_calibration()
+    keymaps = load_keymaps()
+    key_lanes = keymaps[song_data['keys']]
+    view = GameView(SCREEN_WIDTH, SCREEN_HEIGHT, font, big_font, text_cache, effects, SpriteAtlas(assets, SCREEN_HEIGHT))
+    note_pool = NotePool()
+    game = None
     paused = False
-    hit_display_text = ""
-    hit_display_count = 0
-    hit_display_timer = 0
-    hit_display_alpha = 0
-    fire_anim_frame = 0
-    fire_text_glow = 0
 
     game_state = 'menu'
-    song_start_time = 0
-
-    def reset_rhythm_state():
-        nonlocal notes, next_note_index, score, combo, max_combo, multiplier, health, hit_counts
-        nonlocal paused, hit_display_text, hit_display_count, hit_display_timer, hit_display_alpha
-        nonlocal fire_anim_frame, fire_text_glow, game_state, song_start_time
-
-        notes = []
-        next_note_index = 0
-        score = 0
-        combo = 0
-        max_combo = 0
-        multiplier = 1.0
-        health = HEALTH_MAX
-        hit_counts = {k: 0 for k in list(HIT_WINDOWS.keys()) + ['miss']}
+    song_clock = None
+    music_loaded = False
+
+    def start_song():
+        nonlocal game, paused, game_state, song_clock, music_loaded, key_lanes
+        # Load music, it starts playing once the lead-in is over
+        music_loaded = False
+        if song_path and os.path.isfile(song_path):
+            try:
+                # Usually already read into memory while the song was highlighted
+                pygame.mixer.music.load(assets.get_audio(song_path), os.path.splitext(song_path)[1][1:])
+                music_loaded = True
+            except Exception as e:
+                print(f"Error loading music: {e}")
+
+        if game:
+            game.release_notes()
+        game = Game(note_times, note_masks, get_scroll_speed(note_speed), song_data['keys'], note_pool, chart_stream)
+        key_lanes = keymaps[game.keys]
+        view.set_keys(game.keys)
+        view.reset()
         paused = False
-        hit_display_text = ""
-        hit_display_count = 0
-        hit_display_timer = 0
-        hit_display_alpha = 0
-        fire_anim_frame = 0
-        fire_text_glow = 0
         game_state = 'playing'
-        song_start_time = pygame.time.get_ticks()
-
-    def update_multiplier(combo):
-        if combo >= 50:
-            return 2.0
-        elif combo >= 30:
-            return 1.5
-        elif combo >= 15:
-            return 1.2
-        else:
-            return 1.0
-
-    def spawn_note_from_line(line):
-        parts = line.split()
-        for i, char in enumerate(parts):
-            if char == 'o':
-                direction = DIRECTIONS[i]
-                note = Note(direction, note_images[direction], COLUMN_X[direction])
-                notes.append(note)
+        song_clock = SongClock(game.lead_time, calibration['audio_offset'], calibration['visual_offset'])
+        perf.restart()
+        if PROFILE_ON_START:
+            perf.start_profile(PROFILE_ON_START)
+
+    def finish_song():
+        nonlocal game_state
+        game_state = 'results'
+        pygame.mixer.music.stop()
+        if chart_stream:
+            # The replay and score are keyed by the hash of the whole chart
+            chart_stream.wait()
+        replay_path = save_replay(game, selected_json_file, note_speed)
+        score_store.submit(get_score_record(game, selected_json_file, replay_path))
+        perf.save_profiles()
 
     def draw_text_centered(surface, text, font, color, y):
-        text_surf = font.render(text, True, color)
+        text_surf = text_cache.render(font, text, color)
         x = (SCREEN_WIDTH - text_surf.get_width()) // 2
         surface.blit(text_surf, (x, y))
 
-    speed = note_speed
-
     running = True
-    fire_active = False
+    idle = False
+    drawn_state = None
+    # Input is polled and judged at INPUT_HZ, frames are only drawn every
+    # frame_interval ms, so a key press never waits for a frame to be drawn
+    frame_interval = 1000 / FPS if FPS else 0
+    next_frame_ticks = 0
 
     while running:
-        clock.tick(FPS)
-
-        # Update fire effect
-        fire_active = combo >= FIRE_COMBO_THRESHOLD
-        if fire_active:
-            fire_anim_frame = (fire_anim_frame + 1) % len(fire_colors)
-            fire_text_glow = min(255, fire_text_glow + 25)
-        else:
-            fire_text_glow = max(0, fire_text_glow - 25)
+        clock.tick(IDLE_FPS if idle else INPUT_HZ)
+        perf.begin()
 
         for event in pygame.event.get():
+            # Key presses during play only touch the dirty rects they change
+            if game_state != 'playing' or event.type not in (pygame.KEYDOWN, pygame.KEYUP):
+                renderer.invalidate()
             if event.type == pygame.QUIT:
                 running = False
 
+            elif event.type == pygame.KEYDOWN and event.key == PERF_HUD_KEY:
+                perf.hud = not perf.hud
+
             elif event.type == pygame.KEYDOWN:
                 if game_state == 'menu':
                     if event.key == pygame.K_RETURN:
-                        reset_rhythm_state()
-                        # Load and play music
-                        if song_path and os.path.isfile(song_path):
-                            try:
-                                pygame.mixer.music.load(song_path)
-                                pygame.mixer.music.play()
-                                song_start_time = pygame.time.get_ticks()
-                            except Exception as e:
-                                print(f"Error loading music: {e}")
-                                song_start_time = pygame.time.get_ticks()
-                        else:
-                            song_start_time = pygame.time.get_ticks()
-                        game_state = 'playing'
+                        start_song()
+
+                    elif event.key == pygame.K_c:
+                        calibration = calibration_screen(screen, font, big_font, text_cache, calibration) or calibration
 
                     elif event.key == pygame.K_ESCAPE:
                         running = False
@@ -268,231 +1887,115 @@ def main():
                         paused = not paused
                         if paused:
                             pygame.mixer.music.pause()
+                            song_clock.pause()
                         else:
                             pygame.mixer.music.unpause()
+                            song_clock.resume()
+                        perf.restart()
 
-                    if not paused and event.key in KEY_MAPPING:
-                        direction = KEY_MAPPING[event.key]
-                        closest_note = None
-                        closest_distance = float('inf')
-                        for note in notes:
-                            if note.direction == direction:
-                                dist = abs(note.y - RECEPTOR_Y)
-                                if dist < closest_distance and dist <= HIT_WINDOWS['trash']:
-                                    closest_note = note
-                                    closest_distance = dist
-
-                        if closest_note:
-                            judgment = get_judgment(closest_distance)
-                            hit_counts[judgment] += 1
-
-                            # Display hit text and count
-                            if judgment == hit_display_text:
-                                hit_display_count += 1
-                            else:
-                                hit_display_text = judgment
-                                hit_display_count = 1
-                            hit_display_timer = 30  # frames
-                            if judgment == 'sick':
-                                score += int(300 * multiplier)
-                                combo += 1
-                            elif judgment == 'good':
-                                score += int(200 * multiplier)
-                                combo += 1
-                            elif judgment == 'bad':
-                                score += int(100 * multiplier)
-                                combo = 0
-                            elif judgment == 'trash':
-                                score += int(50 * multiplier)
-                                combo = 0
-
-                            if combo > max_combo:
-                                max_combo = combo
-                            multiplier = update_multiplier(combo)
-                            health = min(HEALTH_MAX, health + 1)
-                            notes.remove(closest_note)
-                        else:
-                            # Missed key press
-                            hit_counts['miss'] += 1
-                            combo = 0
-                            health -= 10
+                    elif event.key == PROFILE_KEY:
+                        perf.start_profile()
+
+                    if not paused and not game.failed() and event.key in key_lanes:
+                        judgment = game.press(key_lanes[event.key], song_clock.time())
+                        if judgment != 'miss':
+                            view.show_judgment(judgment)
 
                 elif game_state == 'results':
                     if event.key == pygame.K_RETURN:
-                        # Back to song selection menu
-                        selected_json_file = song_selection_menu(screen, font, big_font, json_files, song_titles)
-                        with open(selected_json_file, 'r') as f:
-                            song_data = json.load(f)
-
-                        music_sheet_raw = song_data.get('musicSheet', [])
-                        song_path = song_data.get('song', None)
-                        bpm = song_data.get('bpm', 120)
+                        # Back to song selection menu, picking up changed charts
+                        songs = load_song_library()
+                        json_files = [song['path'] for song in songs]
+                        song_titles = [get_song_label(song) for song in songs]
+                        selected_json_file = song_selection_menu(screen, font, big_font, json_files, song_titles, text_cache, score_store, preload_song)
+                        song_data, note_times, note_masks, chart_stream = open_chart(selected_json_file)
+                        selected_title = song_titles[json_files.index(selected_json_file)]
+                        song_path = resolve_song_path(selected_json_file, song_data.get('song'))
                         note_speed = song_data.get('noteSpeed', 15)
 
-                        beat_interval_ms = 60000 / bpm
-                        music_sheet.clear()
-                        for i, line in enumerate(music_sheet_raw):
-                            music_sheet.append({"time": int(i * beat_interval_ms), "line": line})
-
-                        speed = note_speed
-
-                        reset_rhythm_state()
+                        start_song()
                     elif event.key == pygame.K_ESCAPE:
                         running = False
 
-        if game_state == 'playing' and not paused:
-            now = pygame.time.get_ticks() - song_start_time
-            # Spawn notes whose time has come
-            while next_note_index < len(music_sheet) and music_sheet[next_note_index]['time'] <= now:
-                spawn_note_from_line(music_sheet[next_note_index]['line'])
-                next_note_index += 1
+            elif event.type == pygame.KEYUP:
+                if game_state == 'playing' and not paused and not game.failed() and event.key in key_lanes:
+                    judgment = game.key_up(key_lanes[event.key], song_clock.time())
+                    if judgment and judgment != 'miss':
+                        view.show_judgment(judgment)
 
-        # Update notes positions
         if game_state == 'playing' and not paused:
-            for note in notes[:]:
-                note.update(speed)
-                if note.y > SCREEN_HEIGHT + 50:
-                    notes.remove(note)
-                    hit_counts['miss'] += 1
-                    combo = 0
-                    health -= 10
+            now = song_clock.time()
+            if not song_clock.music_started and song_clock.raw_time() >= 0:
+                if music_loaded:
+                    pygame.mixer.music.play()
+                song_clock.start_music()
+
+            perf.phase(0)
+            game.spawn(now)
+            perf.phase(1)
+            game.update(now)
 
         # Check lose condition
-        if health <= 0 and game_state == 'playing':
-            game_state = 'results'
-            pygame.mixer.music.stop()
+        if game_state == 'playing' and game.failed():
+            finish_song()
 
         # Check end of song condition
         if game_state == 'playing':
-            music_finished = not pygame.mixer.music.get_busy()
-            no_notes_left = (next_note_index >= len(music_sheet) and not notes)
-            if music_finished and no_notes_left:
-                game_state = 'results'
-                pygame.mixer.music.stop()
+            music_finished = song_clock.music_started and not pygame.mixer.music.get_busy()
+            if music_finished and not game.notes_left():
+                finish_song()
 
-        # Drawing
-        screen.fill((0, 0, 0))
+        if game_state == 'playing':
+            perf.phase(2)
+
+        # Drawing, idle screens are only redrawn when something invalidated them
+        if game_state != drawn_state:
+            renderer.invalidate()
+            drawn_state = game_state
+        idle = game_state != 'playing' or paused
+        if idle and not renderer.invalidated:
+            continue
+        ticks = pygame.time.get_ticks()
+        if not idle:
+            if ticks < next_frame_ticks:
+                continue
+            next_frame_ticks = max(next_frame_ticks + frame_interval, ticks)
 
         if game_state == 'menu':
-            draw_text_centered(screen, "Pysu!Mania", big_font, (255, 255, 255), SCREEN_HEIGHT // 3)
-            draw_text_centered(screen, "Press ENTER to Start", font, (255, 255, 0), SCREEN_HEIGHT // 2)
-            draw_text_centered(screen, f"Selected Song: {get_song_title(selected_json_file)}", font, (255, 255, 255), SCREEN_HEIGHT // 2 + 50)
+            renderer.begin(full=True)
+            draw_text_centered(renderer, "Pysu!Mania", big_font, (255, 255, 255), SCREEN_HEIGHT // 3)
+            draw_text_centered(renderer, "Press ENTER to Start", font, (255, 255, 0), SCREEN_HEIGHT // 2)
+            draw_text_centered(renderer, f"Selected Song: {selected_title}", font, (255, 255, 255), SCREEN_HEIGHT // 2 + 50)
+            offsets = f"audio {calibration['audio_offset']:+d} ms, visual {calibration['visual_offset']:+d} ms"
+            draw_text_centered(renderer, f"Press C to calibrate ({offsets})", font, (180, 180, 180), SCREEN_HEIGHT // 2 + 100)
 
         elif game_state == 'playing':
-            # Fire effect background if combo high enough
-            if fire_active:
-                overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
-                color = fire_colors[fire_anim_frame]
-                alpha = 60 + (fire_anim_frame * 20)
-                overlay.fill((*color, alpha))
-                screen.blit(overlay, (0, 0))
-
-            # Draw receptors
-            for direction in DIRECTIONS:
-                receptor_img = receptors[direction]
-                x = COLUMN_X[direction] - receptor_img.get_width() // 2
-                y = RECEPTOR_Y - receptor_img.get_height() // 2
-                screen.blit(receptor_img, (x, y))
-
-            # Draw notes
-            for note in notes:
-                note.draw(screen)
-
-            # Draw combo
-            combo_color = (255, 255, 255)
-            combo_scale = 1.0
-            if fire_active:
-                combo_color = fire_colors[fire_anim_frame]
-                combo_scale = 1.2 + 0.1 * (fire_anim_frame % 2)
-            combo_text_surface = font.render(f"Combo: {combo}", True, combo_color)
-            if fire_active:
-                glow = pygame.Surface((combo_text_surface.get_width()+8, combo_text_surface.get_height()+8), pygame.SRCALPHA)
-                pygame.draw.ellipse(glow, (*combo_color, min(180, fire_text_glow)), glow.get_rect())
-                screen.blit(glow, (6, 36))
-            combo_rect = combo_text_surface.get_rect()
-            combo_rect.topleft = (10, 40)
-            if combo_scale != 1.0:
-                combo_text_surface = pygame.transform.smoothscale(combo_text_surface, (int(combo_rect.width*combo_scale), int(combo_rect.height*combo_scale)))
-            screen.blit(combo_text_surface, combo_rect.topleft)
-
-            # Draw health bar
-            health_bar_width = 400
-            health_bar_height = 25
-            health_ratio = health / HEALTH_MAX
-            pygame.draw.rect(screen, (150, 0, 0), (SCREEN_WIDTH - health_bar_width - 20, 20, health_bar_width, health_bar_height))
-            pygame.draw.rect(screen, (0, 200, 0), (SCREEN_WIDTH - health_bar_width - 20, 20, int(health_bar_width * health_ratio), health_bar_height))
-
-            # Draw score and multiplier
-            score_text = font.render(f"Score: {score}", True, (255, 255, 255))
-            multiplier_text = font.render(f"Multiplier: x{multiplier:.1f}", True, (255, 255, 255))
-            screen.blit(score_text, (10, 10))
-            screen.blit(multiplier_text, (10, 70))
-
-            # Fire label
-            if fire_active:
-                fire_label = big_font.render("FIRE!", True, fire_colors[fire_anim_frame])
-                fire_label.set_alpha(200)
-                fx = (SCREEN_WIDTH - fire_label.get_width()) // 2
-                fy = 120
-                screen.blit(fire_label, (fx, fy))
-
-            # Pause hint
-            pause_hint = font.render("Press ESC to Pause/Resume", True, (180, 180, 180))
-            screen.blit(pause_hint, (SCREEN_WIDTH - pause_hint.get_width() - 20, SCREEN_HEIGHT - 40))
-
-            # Hit display text
-            if hit_display_timer > 0 and hit_display_text:
-                display_text = hit_display_text.upper()
-                if hit_display_count > 1:
-                    display_text += f" x{hit_display_count}"
-                hit_text = big_font.render(display_text, True, (255, 255, 255))
-                hit_text.set_alpha(hit_display_alpha)
-                hit_x = min(COLUMN_X.values()) - 180
-                hit_y = RECEPTOR_Y - 50
-                screen.blit(hit_text, (hit_x, hit_y))
-
-                fade_duration = 7  # frames to fade
-                if hit_display_timer > 30 - fade_duration:
-                    hit_display_alpha = int(255 * (1 - (hit_display_timer - (30 - fade_duration)) / fade_duration))
-                elif hit_display_timer < fade_duration:
-                    hit_display_alpha = int(255 * (hit_display_timer / fade_duration))
-                else:
-                    hit_display_alpha = 255
-                hit_display_timer -= 1
-            else:
-                hit_display_text = ""
-                hit_display_count = 0
-                hit_display_alpha = 0
-
-            # Progress bar (optional)
+            progress_ratio = None
             if pygame.mixer.music.get_busy():
-                pos = pygame.mixer.music.get_pos() / 1000.0
                 max_length = 120  # Max length of song in seconds (estimate)
-                progress_ratio = min(pos / max_length, 1.0)
-                bar_width = 400
-                bar_height = 15
-                x = (SCREEN_WIDTH - bar_width) // 2
-                y = 10
-                pygame.draw.rect(screen, (100, 100, 100), (x, y, bar_width, bar_height))
-                pygame.draw.rect(screen, (50, 200, 50), (x, y, int(bar_width * progress_ratio), bar_height))
+                progress_ratio = min(pygame.mixer.music.get_pos() / 1000.0 / max_length, 1.0)
+            view.tick(game.combo)
+            view.begin(renderer)
+            view.draw(renderer, game, song_clock.visual_time(), progress_ratio)
+            perf.draw(renderer, hud_font, text_cache)
 
         elif game_state == 'results':
-            draw_text_centered(screen, "Results", big_font, (255, 255, 255), SCREEN_HEIGHT // 4)
-            acc = 0
-            total_hits = sum(hit_counts[k] for k in ['sick', 'good', 'bad', 'trash'])
-            if total_hits > 0:
-                acc = (hit_counts['sick'] + 0.7 * hit_counts['good'] + 0.4 * hit_counts['bad'] + 0.1 * hit_counts['trash']) / total_hits * 100
-            score_text = font.render(f"Score: {score}", True, (255, 255, 255))
-            combo_text = font.render(f"Max Combo: {max_combo}", True, (255, 255, 255))
-            acc_text = font.render(f"Accuracy: {acc:.2f}%", True, (255, 255, 255))
-            retry_text = font.render("Press ENTER to return to menu, ESC to quit", True, (180, 180, 180))
-
-            screen.blit(score_text, (SCREEN_WIDTH // 2 - score_text.get_width() // 2, SCREEN_HEIGHT // 2))
-            screen.blit(combo_text, (SCREEN_WIDTH // 2 - combo_text.get_width() // 2, SCREEN_HEIGHT // 2 + 40))
-            screen.blit(acc_text, (SCREEN_WIDTH // 2 - acc_text.get_width() // 2, SCREEN_HEIGHT // 2 + 80))
-            screen.blit(retry_text, (SCREEN_WIDTH // 2 - retry_text.get_width() // 2, SCREEN_HEIGHT - 100))
-
-        pygame.display.flip()
+            renderer.begin(full=True)
+            draw_text_centered(renderer, "Results", big_font, (255, 255, 255), SCREEN_HEIGHT // 4)
+            score_text = text_cache.render(font, f"Score: {game.score}", (255, 255, 255))
+            combo_text = text_cache.render(font, f"Max Combo: {game.max_combo}", (255, 255, 255))
+            acc_text = text_cache.render(font, f"Accuracy: {game.accuracy():.2f}%", (255, 255, 255))
+            retry_text = text_cache.render(font, "Press ENTER to return to menu, ESC to quit", (180, 180, 180))
+
+            renderer.blit(score_text, (SCREEN_WIDTH // 2 - score_text.get_width() // 2, SCREEN_HEIGHT // 2))
+            renderer.blit(combo_text, (SCREEN_WIDTH // 2 - combo_text.get_width() // 2, SCREEN_HEIGHT // 2 + 40))
+            renderer.blit(acc_text, (SCREEN_WIDTH // 2 - acc_text.get_width() // 2, SCREEN_HEIGHT // 2 + 80))
+            renderer.blit(retry_text, (SCREEN_WIDTH // 2 - retry_text.get_width() // 2, SCREEN_HEIGHT - 100))
+
+        renderer.end()
+        if game_state == 'playing':
+            perf.phase(3)
+            perf.frame(game)
 
     pygame.quit()
     sys.exit()
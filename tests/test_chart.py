@@ -0,0 +1,60 @@
+import json
+import os
+import random
+import sys
+from itertools import count
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+def compile_sheet(rows, keys=main.DEFAULT_KEYS):
+    _, times, masks = main.compile_chart({'keys': keys, 'musicSheet': [{'time': t, 'line': line} for t, line in rows]})
+    return list(zip(times, masks))
+
+def test_hold_cut_by_next_note_is_a_tap():
+    assert compile_sheet([(1000, 'h . . .'), (1200, 'o . . .'), (1400, 't . . .')]) == [(1000, 1), (1200, 1)]
+
+def test_tail_without_hold_is_dropped():
+    head, tail = 1 << main.HOLD_HEAD_SHIFT, 1 << main.HOLD_TAIL_SHIFT
+    assert compile_sheet([(1000, '. t . .'), (1200, 'h o . .'), (1400, 't t . .')]) == [(1200, head | 2), (1400, tail)]
+
+def test_streamed_chart_matches_compiled(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(0)
+    rows = [(i * 60, ' '.join(rng.choice('...oht') for _ in range(4))) for i in range(3000)]
+    with open('chart.jsonl', 'w') as f:
+        f.write(json.dumps({'format': main.LINE_CHART_FORMAT, 'keys': 4}) + '\n')
+        for t, line in rows:
+            f.write(json.dumps({'time': t, 'line': line}) + '\n')
+    meta, times, masks, stream = main.open_chart('chart.jsonl')
+    assert stream is not None
+    stream.wait()
+    assert stream.error is None
+    assert list(zip(times, masks)) == compile_sheet(rows)
+    assert meta['keys'] == 4
+
+def test_hold_without_tail_is_given_up():
+    consumed = []
+    def rows():
+        yield 0, 'h . . .'
+        for i in count(1):
+            consumed.append(i)
+            yield i * 100, '. o . .'
+    first = next(main.compile_rows(rows(), 4))
+    assert first == (0, 1)
+    assert len(consumed) <= main.HOLD_MAX_MS // 100 + 1
+
+def test_chart_cache_rejected_after_source_changes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('chart.json', 'w') as f:
+        json.dump({'keys': 4, 'musicSheet': [{'time': 1000, 'line': 'o . . .'}]}, f)
+    main.open_chart('chart.json')
+    meta, times, masks = main.get_cached_chart('chart.json', os.stat('chart.json'))
+    assert list(zip(times, masks)) == [(1000, 1)]
+    del times, masks
+
+    stat = os.stat('chart.json')
+    os.utime('chart.json', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert main.get_cached_chart('chart.json', os.stat('chart.json')) is None
@@ -0,0 +1,78 @@
+import os
+import random
+import sys
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+NOTE_SPEED = 15
+
+def compile_sheet(rows, keys=main.DEFAULT_KEYS):
+    _, times, masks = main.compile_chart({'keys': keys, 'musicSheet': [{'time': t, 'line': line} for t, line in rows]})
+    return times, masks
+
+def play_live(times, masks, inputs, keys=main.DEFAULT_KEYS):
+    # The main loop at one update per ms: spawn, key events due this ms, update
+    game = main.Game(times, masks, main.get_scroll_speed(NOTE_SPEED), keys)
+    inputs = sorted(inputs)
+    next_input = 0
+    now = -int(game.lead_time)
+    while (game.notes_left() or next_input < len(inputs)) and not game.failed():
+        game.spawn(now)
+        while next_input < len(inputs) and inputs[next_input][0] <= now:
+            _, lane, down = inputs[next_input]
+            if not game.failed():
+                if down:
+                    game.press(lane, now)
+                else:
+                    game.key_up(lane, now)
+            next_input += 1
+        game.update(now)
+        now += 1
+    return game
+
+def replay(game, times, masks, keys=main.DEFAULT_KEYS):
+    return main.simulate_replay(times, masks, NOTE_SPEED, game.input_times, game.input_codes, keys)
+
+def test_hold_ending_before_next_expiry():
+    times, masks = compile_sheet([(1000, 'h . . .'), (1300, '. o . .'), (1400, 't . . .')])
+    live = play_live(times, masks, [(1000, 0, True)])
+    assert live.max_combo == 2
+    assert main.get_results(replay(live, times, masks)) == main.get_results(live)
+
+def test_random_hold_plays_replay_exactly():
+    for seed in range(20):
+        rng = random.Random(seed)
+        keys = rng.choice(sorted(main.LANE_SPRITES))
+        rows = []
+        open_holds = set()
+        row_time = 500
+        for _ in range(150):
+            row_time += rng.choice([40, 90, 150])
+            line = []
+            for lane in range(keys):
+                if lane in open_holds:
+                    char = rng.choice('..t')
+                    if char == 't':
+                        open_holds.discard(lane)
+                else:
+                    char = rng.choice('...oh')
+                    if char == 'h':
+                        open_holds.add(lane)
+                line.append(char)
+            rows.append((row_time, ' '.join(line)))
+        times, masks = compile_sheet(rows, keys)
+
+        # Presses around each note, some holds let go early, some held through
+        inputs = []
+        for hit_time, mask in zip(times, masks):
+            for lane in range(keys):
+                if mask >> lane & 1 or mask >> (main.HOLD_HEAD_SHIFT + lane) & 1:
+                    if rng.random() < 0.8:
+                        press = hit_time + rng.randint(-150, 150)
+                        inputs.append((press, lane, True))
+                        inputs.append((press + rng.randint(20, 1500), lane, False))
+        live = play_live(times, masks, inputs, keys)
+        assert main.get_results(replay(live, times, masks, keys)) == main.get_results(live), seed
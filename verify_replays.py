@@ -0,0 +1,45 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import main
+
+def find_replays(paths):
+    replays = []
+    for path in paths:
+        if os.path.isdir(path):
+            replays.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.pysr'))
+        else:
+            replays.append(path)
+    return replays
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Re-verify Pysu!Mania replays with the current scoring")
+    parser.add_argument('paths', nargs='*', default=[main.REPLAY_DIR], help="replay files or directories")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--json', help="also write every result to this file")
+    args = parser.parse_args(argv)
+
+    replays = find_replays(args.paths)
+    results = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        chunksize = max(1, len(replays) // (args.workers * 4 or 1))
+        for result in pool.map(main.verify_replay, replays, chunksize=chunksize):
+            results.append(result)
+            if not result['ok']:
+                failed += 1
+                reason = result.get('error') or f"claimed {result['claimed']}, got {result['results']}"
+                print(f"MISMATCH {result['replay']}: {reason}")
+
+    print(f"{len(results) - failed}/{len(results)} replays verified")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())